@@ -0,0 +1,169 @@
+"""Local OpenAI-compatible chat-completions server for benchmarks.
+
+Serves both the Groq path (/openai/v1/chat/completions) and the OpenAI /
+Hugging Face path (/v1/chat/completions) with configurable latency, error
+rate, 429 rate and response length. Batched SRT prompts ([[N]] markers) are
+answered with the same markers so the bot's batch parser accepts them.
+
+    python bench/fake_llm_server.py --port 8900 --latency-ms 400 --jitter 0.3
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+MARKER_RE = re.compile(r'^\s*\[\[(\d+)\]\]\s*$', re.MULTILINE)
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit")
+
+
+class FakeLLM:
+    """Generates fake completions with a log-normal latency distribution"""
+
+    def __init__(self, latency_ms=300.0, jitter=0.3, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1.0, response_words=20, stream_chunk_words=3, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.response_words = response_words
+        self.stream_chunk_words = stream_chunk_words
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def latency(self):
+        """Seconds to wait before answering"""
+        if self.jitter <= 0:
+            return self.latency_ms / 1000.0
+        return self.random.lognormvariate(0, self.jitter) * self.latency_ms / 1000.0
+
+    def text_for(self, messages):
+        """Fake translation; keeps [[N]] markers of batched SRT prompts"""
+        prompt = messages[-1]["content"] if messages else ""
+        words = " ".join(self.random.choice(WORDS) for _ in range(self.response_words))
+        markers = MARKER_RE.findall(prompt)
+        if markers:
+            return "\n".join(f"[[{n}]]\n{words}" for n in markers)
+        return words
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency())
+
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.rate_limited += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": str(self.retry_after)}
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            return JSONResponse({"error": {"message": "Internal error", "type": "server_error"}}, status_code=500)
+
+        text = self.text_for(body.get("messages", []))
+        model = body.get("model", "fake")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        prompt_tokens = sum(len(m.get("content", "")) // 4 for m in body.get("messages", []))
+        completion_tokens = len(text) // 4
+
+        if body.get("stream"):
+            return StreamingResponse(
+                self._stream(completion_id, model, text),
+                media_type="text/event-stream"
+            )
+
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        })
+
+    async def _stream(self, completion_id, model, text):
+        words = text.split(" ")
+        for i in range(0, len(words), self.stream_chunk_words):
+            piece = " ".join(words[i:i + self.stream_chunk_words])
+            if i:
+                piece = " " + piece
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(0.01)
+        yield "data: [DONE]\n\n"
+
+    async def health(self, request):
+        return JSONResponse({
+            "status": "healthy",
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited
+        })
+
+    def app(self):
+        return Starlette(routes=[
+            Route("/openai/v1/chat/completions", self.chat_completions, methods=["POST"]),
+            Route("/v1/chat/completions", self.chat_completions, methods=["POST"]),
+            Route("/health", self.health),
+        ])
+
+
+def add_arguments(parser):
+    """Fake server options, shared with run_bench.py"""
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="median response latency")
+    parser.add_argument("--jitter", type=float, default=0.3, help="log-normal sigma of the latency (0 = fixed)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after seconds sent with 429s")
+    parser.add_argument("--response-words", type=int, default=20, help="words per fake translation")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = FakeLLM(
+        latency_ms=args.latency_ms,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        response_words=args.response_words,
+        seed=args.seed
+    )
+    uvicorn.run(fake.app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+"""Offline load test that replays Telegram updates through the real handlers.
+
+Builds the bot's Application with a recording BaseRequest in place of the Bot
+API and stub chat-completion clients in place of Groq / Sea Lion, then feeds
+updates into application.update_queue at a Poisson arrival rate. Synthetic
+updates mix /start, language commands, text messages and SRT uploads; a JSONL
+file of recorded Update objects can be replayed instead.
+
+For every offered rate it reports end-to-end handler latency, queueing delay
+(enqueue -> first handler) and event-loop lag, and finally the highest rate
+the bot sustained:
+
+    python bench/replay_updates.py --rates 25 50 100 200 --duration 10 --latency-ms 400
+    python bench/replay_updates.py --updates recorded.jsonl --rates 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_llm_server import FakeLLM, add_arguments  # noqa: E402
+from run_bench import SAMPLE_SENTENCES, latency_summary, percentile, synthetic_srt  # noqa: E402
+
+REPLAY_TOKEN = "123456:REPLAY"
+
+
+def load_bot(args, data_dir):
+    """Import bot.py with dummy keys and local storage"""
+    os.environ.update({
+        "TELEGRAM_TOKEN": REPLAY_TOKEN,
+        "GROQ_API_KEYS": ",".join(f"replay-groq-{i}" for i in range(args.keys)),
+        "SEA_LION_API_KEYS": ",".join(f"replay-sea-{i}" for i in range(args.keys)),
+        "DATA_DIR": data_dir,
+        "SETTINGS_BACKEND": "memory",
+    })
+    if not args.rate_limits:
+        os.environ.update({"GROQ_RPM": "0", "GROQ_TPM": "0", "SEA_LION_RPM": "0", "SEA_LION_TPM": "0"})
+    if not args.flood_control:
+        os.environ.update({"TELEGRAM_GLOBAL_RATE": "0", "TELEGRAM_CHAT_RATE": "0", "TELEGRAM_GROUP_RATE": "0"})
+    import bot
+    return bot
+
+
+class StubAPIError(Exception):
+    """Upstream error carrying a status code like the groq/openai exceptions"""
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"stub upstream error {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = SimpleNamespace(headers=headers)
+
+
+class StubCompletions:
+    """chat.completions stand-in answering from FakeLLM without any network"""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    async def create(self, model, messages, temperature=None, max_tokens=None, stream=False):
+        fake = self.fake
+        fake.requests += 1
+        await asyncio.sleep(fake.latency())
+        roll = fake.random.random()
+        if roll < fake.rate_limit_rate:
+            fake.rate_limited += 1
+            raise StubAPIError(429, fake.retry_after)
+        if roll < fake.rate_limit_rate + fake.error_rate:
+            fake.errors += 1
+            raise StubAPIError(500)
+
+        text = fake.text_for(messages)
+        if stream:
+            return self._stream(text)
+        prompt_tokens = sum(len(m["content"]) // 4 for m in messages)
+        completion_tokens = len(text) // 4
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens
+            )
+        )
+
+    async def _stream(self, text):
+        words = text.split(" ")
+        for i in range(0, len(words), self.fake.stream_chunk_words):
+            piece = " ".join(words[i:i + self.fake.stream_chunk_words])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=(" " if i else "") + piece))])
+            await asyncio.sleep(0.01)
+
+
+class StubClient:
+    def __init__(self, fake):
+        self.chat = SimpleNamespace(completions=StubCompletions(fake))
+
+    async def close(self):
+        pass
+
+
+def install_stub_providers(bot, fake):
+    """Give every pooled key a stub client; key pool, scheduler and metrics stay real"""
+    for provider in (bot.groq_provider, bot.sealion_provider):
+        for key in provider.pool.keys:
+            key.client_factory = lambda api_key: StubClient(fake)
+
+
+def make_recording_request(srt_bytes, latency):
+    """BaseRequest that records Bot API calls and answers them locally"""
+    from telegram.request import BaseRequest
+
+    class RecordingRequest(BaseRequest):
+        def __init__(self):
+            self.calls = Counter()
+            self.message_ids = 0
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def _message(self, parameters, **extra):
+            self.message_ids += 1
+            chat_id = int(parameters.get("chat_id") or 0)
+            return {
+                "message_id": self.message_ids,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                **extra
+            }
+
+        async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                             write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                             pool_timeout=BaseRequest.DEFAULT_NONE):
+            if latency:
+                await asyncio.sleep(latency)
+            if "/file/bot" in url:
+                self.calls["downloadFile"] += 1
+                return 200, srt_bytes
+
+            endpoint = url.rsplit("/", 1)[-1]
+            self.calls[endpoint] += 1
+            parameters = request_data.parameters if request_data else {}
+            if endpoint == "getMe":
+                result = {"id": 123456, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+            elif endpoint == "getFile":
+                result = {
+                    "file_id": parameters.get("file_id"),
+                    "file_unique_id": str(parameters.get("file_id")),
+                    "file_size": len(srt_bytes),
+                    "file_path": "documents/replay.srt"
+                }
+            elif endpoint in ("sendMessage", "editMessageText"):
+                result = self._message(parameters, text=str(parameters.get("text", "")))
+            elif endpoint == "sendDocument":
+                result = self._message(parameters, document={"file_id": "out", "file_unique_id": "out"})
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+    return RecordingRequest()
+
+
+class SyntheticUpdates:
+    """Generates Bot API update dicts for a weighted mix of update kinds"""
+
+    def __init__(self, bot, args, rng, srt_size):
+        self.bot = bot
+        self.rng = rng
+        self.users = args.users
+        self.srt_size = srt_size
+        kinds, weights = zip(*((kind, float(weight)) for kind, weight in
+                               (item.split("=") for item in args.mix.split(","))))
+        self.kinds = kinds
+        self.weights = weights
+        self.lang_codes = sorted(bot.LANG_CODES)
+
+    def next(self, update_id):
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        user_id = self.rng.randrange(1, self.users + 1)
+        if kind == "start":
+            return kind, command_update(update_id, user_id, "/start")
+        if kind == "lang":
+            return kind, command_update(update_id, user_id, f"/{self.rng.choice(self.lang_codes)}")
+        if kind == "srt":
+            return kind, message_update(update_id, user_id, document={
+                "file_id": f"srt-{update_id}",
+                "file_unique_id": f"srt-{update_id}",
+                "file_name": "episode.srt",
+                "mime_type": "application/x-subrip",
+                "file_size": self.srt_size
+            })
+        # Unique text per message so the cache does not hide upstream latency
+        return "text", message_update(update_id, user_id, text=f"{self.rng.choice(SAMPLE_SENTENCES)} #{update_id}")
+
+
+class RecordedUpdates:
+    """Cycles through recorded Update JSON objects, renumbering update ids"""
+
+    def __init__(self, path):
+        with open(path, encoding="utf-8") as f:
+            self.updates = [json.loads(line) for line in f if line.strip()]
+        if not self.updates:
+            raise SystemExit(f"No updates in {path}")
+        self.position = 0
+
+    def next(self, update_id):
+        data = dict(self.updates[self.position % len(self.updates)])
+        self.position += 1
+        data["update_id"] = update_id
+        message = data.get("message") or {}
+        if message.get("document"):
+            kind = "srt"
+        elif str(message.get("text", "")).startswith("/"):
+            kind = "command"
+        else:
+            kind = "text" if "message" in data else "other"
+        return kind, data
+
+
+def message_update(update_id, user_id, text=None, document=None):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    }
+    if text is not None:
+        message["text"] = text
+    if document is not None:
+        message["document"] = document
+    return {"update_id": update_id, "message": message}
+
+
+def command_update(update_id, user_id, command):
+    data = message_update(update_id, user_id, text=command)
+    data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return data
+
+
+class ReplayStats:
+    """Per-update timestamps: enqueued, first handler started, last handler finished"""
+
+    def __init__(self):
+        self.enqueued = {}
+        self.started = {}
+        self.finished = {}
+        self.kinds = {}
+
+    def pending(self):
+        return len(self.enqueued) - len(self.finished)
+
+    def summary(self, offered_rate, loop_lag):
+        done = [uid for uid in self.enqueued if uid in self.finished]
+        latencies = [self.finished[uid] - self.enqueued[uid] for uid in done]
+        queueing = [self.started[uid] - self.enqueued[uid] for uid in done if uid in self.started]
+        by_kind = defaultdict(list)
+        for uid in done:
+            by_kind[self.kinds[uid]].append(self.finished[uid] - self.enqueued[uid])
+        # Arrivals and completions are each measured over their own window, so the drain after
+        # the last arrival and the Poisson spread around the nominal rate do not skew the comparison
+        arrival_window = (max(self.enqueued.values()) - min(self.enqueued.values())) if self.enqueued else 0.0
+        completion_window = (max(self.finished[uid] for uid in done) - min(self.finished[uid] for uid in done)
+                             if done else 0.0)
+        return {
+            "offered_rate": offered_rate,
+            "updates": len(self.enqueued),
+            "completed": len(done),
+            "arrival_rate": round(len(self.enqueued) / arrival_window, 2) if arrival_window else 0.0,
+            "achieved_rate": round(len(done) / completion_window, 2) if completion_window else 0.0,
+            "latency": latency_summary(latencies),
+            "queueing_delay": latency_summary(queueing),
+            "latency_by_kind": {kind: latency_summary(values) for kind, values in sorted(by_kind.items())},
+            "event_loop_lag": {
+                "p99_ms": round(percentile(loop_lag, 99) * 1000, 2),
+                "max_ms": round(max(loop_lag) * 1000, 2) if loop_lag else 0.0,
+            },
+        }
+
+
+async def sample_loop_lag(samples, interval=0.01):
+    """Record how late a short sleep wakes up; large values mean something blocked the loop"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - started - interval))
+
+
+async def run_step(application, source, rate, args, rng, first_update_id):
+    """Offer `rate` updates/sec for args.duration seconds, then wait for the backlog to drain"""
+    from telegram import Update
+
+    stats = ReplayStats()
+    application.bot_data["replay_stats"] = stats
+    loop_lag = []
+    lag_task = asyncio.create_task(sample_loop_lag(loop_lag))
+    update_id = first_update_id
+    started = time.perf_counter()
+    next_arrival = started
+    while next_arrival < started + args.duration:
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind, data = source.next(update_id)
+        update = Update.de_json(data, application.bot)
+        stats.kinds[update_id] = kind
+        stats.enqueued[update_id] = time.perf_counter()
+        await application.update_queue.put(update)
+        update_id += 1
+        next_arrival += rng.expovariate(rate)
+
+    deadline = time.perf_counter() + args.drain_timeout
+    while stats.pending() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    lag_task.cancel()
+    summary = stats.summary(rate, loop_lag)
+    summary["drained"] = not stats.pending()
+    return summary, update_id
+
+
+def sustainable(step, args):
+    """A rate is sustained when every update finished, throughput kept up with the actual arrivals
+    and queueing stayed bounded"""
+    return (
+        step["drained"]
+        and step["achieved_rate"] >= 0.9 * step["arrival_rate"]
+        and step["queueing_delay"]["p99_ms"] <= args.max_queue_delay_ms
+    )
+
+
+async def replay(bot, args):
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    rng = random.Random(args.seed)
+    fake = FakeLLM(
+        latency_ms=args.latency_ms,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        response_words=args.response_words,
+        seed=args.seed
+    )
+    install_stub_providers(bot, fake)
+    srt_bytes = synthetic_srt(args.srt_cues, rng).encode("utf-8")
+    request = make_recording_request(srt_bytes, args.telegram_latency_ms / 1000.0)
+    application = bot.build_application(request=request)
+
+    # Timestamp every update before the first handler group and after the last one
+    async def mark_started(update, context):
+        stats = context.bot_data.get("replay_stats")
+        if stats is not None:
+            stats.started.setdefault(update.update_id, time.perf_counter())
+
+    async def mark_finished(update, context):
+        stats = context.bot_data.get("replay_stats")
+        if stats is not None:
+            stats.finished[update.update_id] = time.perf_counter()
+
+    application.add_handler(TypeHandler(Update, mark_started), group=-1)
+    application.add_handler(TypeHandler(Update, mark_finished), group=1)
+
+    if args.updates:
+        source = RecordedUpdates(args.updates)
+    else:
+        source = SyntheticUpdates(bot, args, rng, len(srt_bytes))
+
+    steps = []
+    async with application:
+        await application.start()
+        await bot.srt_jobs.start(application.bot)
+        try:
+            update_id = 1
+            for rate in args.rates:
+                step, update_id = await run_step(application, source, rate, args, rng, update_id)
+                steps.append(step)
+                print(f"📈 {rate:g}/s ({step['arrival_rate']}/s arrived) → {step['achieved_rate']}/s, "
+                      f"p99 latency {step['latency']['p99_ms']} ms, "
+                      f"p99 queueing {step['queueing_delay']['p99_ms']} ms, "
+                      f"max loop lag {step['event_loop_lag']['max_ms']} ms")
+                if args.stop_on_overload and not sustainable(step, args):
+                    break
+        finally:
+            await bot.srt_jobs.stop()
+            await application.stop()
+    await bot.close_resources(application)
+
+    passing = [step["offered_rate"] for step in steps if sustainable(step, args)]
+    return {
+        "steps": steps,
+        "max_sustainable_rate": max(passing) if passing else 0,
+        "bot_api_calls": dict(request.calls),
+        "fake_llm": {"requests": fake.requests, "errors": fake.errors, "rate_limited": fake.rate_limited},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rates", type=float, nargs="+", default=[25, 50, 100, 200],
+                        help="offered update rates (updates/sec), run in order")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of arrivals per rate")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds to wait for the backlog after arrivals")
+    parser.add_argument("--max-queue-delay-ms", type=float, default=1000,
+                        help="p99 queueing delay a sustainable rate may reach")
+    parser.add_argument("--stop-on-overload", action="store_true", help="stop after the first unsustainable rate")
+    parser.add_argument("--updates", help="JSONL file of recorded Telegram updates to replay instead of synthetic ones")
+    parser.add_argument("--mix", default="text=0.88,lang=0.06,start=0.03,srt=0.03",
+                        help="synthetic update kinds and weights (text, lang, start, srt)")
+    parser.add_argument("--users", type=int, default=500, help="distinct simulated chats")
+    parser.add_argument("--srt-cues", type=int, default=200, help="cues in each uploaded SRT file")
+    parser.add_argument("--telegram-latency-ms", type=float, default=30, help="simulated Bot API round trip")
+    parser.add_argument("--keys", type=int, default=4, help="stub API keys per provider")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the bot's per-key RPM/TPM limits (off by default)")
+    parser.add_argument("--flood-control", action="store_true",
+                        help="keep the outbound Telegram rate limits (off by default; they cap replies at 30/s)")
+    parser.add_argument("--output", default="replay_results.json", help="JSON results file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    bot = load_bot(args, tempfile.mkdtemp(prefix="translatebot-replay-"))
+    started = time.time()
+    results = asyncio.run(replay(bot, args))
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started)),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"🏁 Max sustainable rate: {results['max_sustainable_rate']:g} updates/sec")
+    print(f"📄 Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""Throughput benchmarks against a local fake LLM server.
+
+Starts bench/fake_llm_server.py in a subprocess, points the Groq and Sea Lion
+clients at it and measures:
+
+* the translate_ai path: messages/sec and p50/p99 latency
+* the SRT path (parse -> translate_srt_entries -> serialize_srt): cues/sec
+* raw parse_srt_content / iter_srt_cues throughput on a large synthetic file
+
+Results are printed and written as JSON so runs can be compared:
+
+    python bench/run_bench.py --messages 500 --concurrency 50 --latency-ms 400 --output before.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_llm_server import WORDS, add_arguments  # noqa: E402
+
+SAMPLE_SENTENCES = (
+    "Where is the nearest train station?",
+    "I will send you the documents tomorrow morning.",
+    "Thank you very much for your help today.",
+    "The meeting has been moved to next Friday at three.",
+    "Please call me when you arrive at the hotel.",
+)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def latency_summary(latencies):
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fetch_json(url):
+    with urllib.request.urlopen(url, timeout=2) as response:
+        return json.loads(response.read())
+
+
+def start_fake_server(args, port):
+    """Launch the fake server and wait until it answers /health"""
+    command = [
+        sys.executable, os.path.join(BENCH_DIR, "fake_llm_server.py"),
+        "--port", str(port),
+        "--latency-ms", str(args.latency_ms),
+        "--jitter", str(args.jitter),
+        "--error-rate", str(args.error_rate),
+        "--rate-limit-rate", str(args.rate_limit_rate),
+        "--retry-after", str(args.retry_after),
+        "--response-words", str(args.response_words),
+    ]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            fetch_json(f"http://127.0.0.1:{port}/health")
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("fake LLM server did not start")
+
+
+def load_bot(args, port, data_dir):
+    """Import bot.py configured against the fake server"""
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:BENCHMARK",
+        "GROQ_API_KEYS": ",".join(f"bench-groq-{i}" for i in range(args.keys)),
+        "SEA_LION_API_KEYS": ",".join(f"bench-sea-{i}" for i in range(args.keys)),
+        "GROQ_BASE_URL": f"http://127.0.0.1:{port}",
+        "SEA_LION_BASE_URL": f"http://127.0.0.1:{port}/v1/",
+        "DATA_DIR": data_dir,
+        "SETTINGS_BACKEND": "memory",
+    })
+    if not args.rate_limits:
+        os.environ.update({"GROQ_RPM": "0", "GROQ_TPM": "0", "SEA_LION_RPM": "0", "SEA_LION_TPM": "0"})
+    return importlib.import_module("bot")
+
+
+class FakeMessage:
+    """Just enough of telegram.Message for the handlers"""
+
+    def __init__(self, text, chat_id):
+        self.text = text
+        self.chat_id = chat_id
+        self.message_id = 1
+        self.replies = []
+        self.chat = SimpleNamespace(send_action=self._noop)
+
+    async def _noop(self, *args, **kwargs):
+        return True
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+
+def make_update(user_id, text):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=user_id),
+        message=FakeMessage(text, user_id),
+    )
+
+
+def synthetic_srt(cues, rng, repeat_ratio=0.0):
+    """Build an SRT file with `cues` cues; repeat_ratio of them are recurring lines"""
+    blocks = []
+    for i in range(cues):
+        start = i * 3
+        if rng.random() < repeat_ratio:
+            text = rng.choice(("[music]", "Thank you.", "What?", "Let's go!"))
+        else:
+            text = f"{rng.choice(SAMPLE_SENTENCES)} ({i})\n{' '.join(rng.choice(WORDS) for _ in range(6))}"
+        blocks.append(
+            f"{i + 1}\n"
+            f"{start // 3600:02}:{start // 60 % 60:02}:{start % 60:02},000 --> "
+            f"{start // 3600:02}:{start // 60 % 60:02}:{start % 60 + 2:02},500\n"
+            f"{text}\n"
+        )
+    return "\n".join(blocks)
+
+
+async def bench_messages(bot, args, rng):
+    """translate_ai end to end with `concurrency` messages in flight"""
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        nonlocal failures
+        # Unique text per message so the cache does not hide upstream latency
+        update = make_update(i % args.users, f"{rng.choice(SAMPLE_SENTENCES)} #{i}")
+        async with semaphore:
+            started = time.perf_counter()
+            await bot.translate_ai(update, SimpleNamespace(args=[]))
+            latencies.append(time.perf_counter() - started)
+        if not update.message.replies or update.message.replies[-1].startswith(("⚠️", "❌")):
+            failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.messages)))
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": args.messages,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_sec": round(args.messages / elapsed, 2),
+        "failures": failures,
+        **latency_summary(latencies),
+    }
+
+
+async def bench_srt(bot, args, rng):
+    """Parse, translate and serialize one synthetic subtitle file"""
+    data = synthetic_srt(args.srt_cues, rng, args.srt_repeat_ratio).encode("utf-8")
+    target_lang = bot.LANG_CODES[args.lang][0]
+    started = time.perf_counter()
+    cues = bot.parse_srt_content(bot.decode_srt_bytes(data))
+    translated = await bot.translate_srt_entries(cues, target_lang)
+    output = bot.serialize_srt(translated)
+    elapsed = time.perf_counter() - started
+    return {
+        "cues": len(cues),
+        "target_lang": target_lang,
+        "batching": bot.SRT_BATCHING,
+        "concurrency": bot.srt_concurrency(),
+        "elapsed_s": round(elapsed, 3),
+        "cues_per_sec": round(len(cues) / elapsed, 2),
+        "output_bytes": len(output),
+    }
+
+
+def bench_parse(bot, args, rng):
+    """Raw parser throughput, best of `repeat` runs"""
+    data = synthetic_srt(args.parse_cues, rng).encode("utf-8")
+    text = data.decode("utf-8")
+    best_bytes = best_text = float("inf")
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        count = sum(1 for _ in bot.iter_srt_cues(data))
+        best_bytes = min(best_bytes, time.perf_counter() - started)
+        started = time.perf_counter()
+        bot.parse_srt_content(text)
+        best_text = min(best_text, time.perf_counter() - started)
+    megabytes = len(data) / 1_000_000
+    return {
+        "cues": count,
+        "megabytes": round(megabytes, 2),
+        "iter_srt_cues_bytes": {
+            "seconds": round(best_bytes, 4),
+            "cues_per_sec": round(count / best_bytes),
+            "mb_per_sec": round(megabytes / best_bytes, 2),
+        },
+        "parse_srt_content_text": {
+            "seconds": round(best_text, 4),
+            "cues_per_sec": round(count / best_text),
+            "mb_per_sec": round(megabytes / best_text, 2),
+        },
+    }
+
+
+async def run_benchmarks(bot, args):
+    rng = random.Random(args.seed)
+    results = {}
+    if "parse" in args.only:
+        results["parse"] = bench_parse(bot, args, rng)
+    if "messages" in args.only:
+        for user_id in range(args.users):
+            await bot.settings_store.update(user_id, lang=args.lang)
+        results["translate_ai"] = await bench_messages(bot, args, rng)
+    if "srt" in args.only:
+        results["srt"] = await bench_srt(bot, args, rng)
+    await bot.groq_provider.aclose()
+    await bot.sealion_provider.aclose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", default=["parse", "messages", "srt"],
+                        choices=["parse", "messages", "srt"], help="benchmarks to run")
+    parser.add_argument("--messages", type=int, default=200, help="messages for the translate_ai benchmark")
+    parser.add_argument("--concurrency", type=int, default=20, help="messages in flight at once")
+    parser.add_argument("--users", type=int, default=50, help="distinct simulated users")
+    parser.add_argument("--lang", default="kh", help="target language code from LANG_CODES")
+    parser.add_argument("--srt-cues", type=int, default=1500, help="cues in the SRT benchmark file")
+    parser.add_argument("--srt-repeat-ratio", type=float, default=0.05, help="fraction of recurring cue lines")
+    parser.add_argument("--parse-cues", type=int, default=100000, help="cues in the parser benchmark file")
+    parser.add_argument("--repeat", type=int, default=3, help="parser benchmark repetitions")
+    parser.add_argument("--keys", type=int, default=4, help="fake API keys per provider")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the bot's per-key RPM/TPM limits (off by default)")
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    port = free_port()
+    data_dir = tempfile.mkdtemp(prefix="translatebot-bench-")
+    server = start_fake_server(args, port)
+    try:
+        bot = load_bot(args, port, data_dir)
+        started = time.time()
+        results = asyncio.run(run_benchmarks(bot, args))
+        server_stats = fetch_json(f"http://127.0.0.1:{port}/health")
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started)),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "fake_server": server_stats,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report["results"], indent=2, ensure_ascii=False))
+    print(f"📄 Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
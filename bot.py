@@ -1,14 +1,46 @@
 import os
+import re
+import sys
 import logging
 import asyncio
 import threading
 import time
-import tempfile
-from flask import Flask, jsonify
+import io
+import codecs
+import sqlite3
+import hashlib
+import json
+import uuid
+import heapq
+import bisect
+import random
+import itertools
+import contextlib
+import contextvars
+import functools
+import unicodedata
+import zipfile
+from collections import OrderedDict, defaultdict, deque
+from typing import NamedTuple
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # optional, only needed for SETTINGS_BACKEND=redis
+    aioredis = None
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from groq import Groq
-from openai import OpenAI
+from telegram.error import RetryAfter
+from telegram.helpers import escape_markdown
+from telegram.ext import (
+    Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
+)
+import httpx
+from groq import AsyncGroq
+from openai import AsyncOpenAI
 
 # ១. កំណត់ Logging ដើម្បីងាយស្រួលមើល Error ក្នុង Logs
 logging.basicConfig(
@@ -39,203 +71,3057 @@ LANG_CODES = {
     "is": ("Icelandic", "🇮🇸"), "sw": ("Swahili", "🇰🇪")
 }
 
-# ៣. ទាញយក API Keys ពី Environment Variables (ជាមួយកន្ទុយ S)
-TOKEN = os.environ.get("TELEGRAM_TOKEN")
+# Extra command names: ISO 639-1 codes where the bot uses a different code, plus a few common ones
+LANG_ALIASES = {
+    "km": "kh", "zh": "ch", "cn": "ch", "vi": "vn", "ja": "jp", "ko": "kr", "hi": "in", "ms": "my",
+    "tl": "ph", "fil": "ph", "he": "iw", "nb": "no", "mm": "myan", "cz": "cs", "gr": "el", "ua": "uk",
+    "kz": "kk", "ge": "ka", "dk": "da"
+}
+# Every accepted language command (code, alias or lower-case English name) -> LANG_CODES key
+LANG_COMMANDS = {
+    **{name.lower(): code for code, (name, _) in LANG_CODES.items()},
+    **LANG_ALIASES,
+    **{code: code for code in LANG_CODES}
+}
+# Language name -> LANG_CODES key
+LANG_NAME_CODES = {name: code for code, (name, _) in LANG_CODES.items()}
+
+def resolve_lang_code(command):
+    """LANG_CODES key for a command like "/en", "/ja@ThisBot" or "japanese", or None
+
+    The @botname suffix is not checked here; the CommandHandler only passes commands for this bot.
+    """
+    return LANG_COMMANDS.get(command.lstrip("/").split("@", 1)[0].lower())
+
+# ៣. ទាញយក API Keys ពី Environment Variables (ជាមួយកន្ទុយ S)
+TOKEN = os.environ.get("TELEGRAM_TOKEN")
+
+# ទាញយក GROQ API Keys (អាចមានច្រើន)
+GROQ_KEYS_STR = os.environ.get("GROQ_API_KEYS", "")
+if GROQ_KEYS_STR:
+    GROQ_KEYS = [key.strip() for key in GROQ_KEYS_STR.split(",") if key.strip()]
+else:
+    GROQ_KEYS = []
+
+# ទាញយក Sea Lion API Keys (អាចមានច្រើន)
+SEA_KEYS_STR = os.environ.get("SEA_LION_API_KEYS", "")
+if SEA_KEYS_STR:
+    SEA_KEYS = [key.strip() for key in SEA_KEYS_STR.split(",") if key.strip()]
+else:
+    SEA_KEYS = []
+
+# Webhook mode is used when WEBHOOK_URL is set, otherwise the bot falls back to polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+PORT = int(os.environ.get("PORT", 10000))
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "0"))
+
+# ត្រួតពិនិត្យ Token
+if not TOKEN:
+    logger.error("❌ ERROR: TELEGRAM_TOKEN not found!")
+    logger.info("💡 Please add TELEGRAM_TOKEN to Render Environment Variables")
+    exit(1)
+
+# Model / endpoint configuration
+GROQ_MODEL = "llama-3.3-70b-versatile"
+SEA_LION_MODEL = "aisingapore/Gemma-SEA-LION-v4-27B-IT"
+SEA_LION_BASE_URL = os.environ.get("SEA_LION_BASE_URL", "https://api-inference.huggingface.co/v1/")
+# Optional override, e.g. to point at the local fake server used by bench/
+GROQ_BASE_URL = os.environ.get("GROQ_BASE_URL") or None
+
+# HTTP timeouts and connection pool size for each API key (seconds / connections)
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "30"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "20"))
+# SDK-level retries stay off by default: the key pool retries on a different key instead
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "0"))
+
+# Per-key rate limits (requests / tokens per minute, 0 = unlimited) and circuit breaker settings
+GROQ_RPM = int(os.environ.get("GROQ_RPM", "30"))
+GROQ_TPM = int(os.environ.get("GROQ_TPM", "12000"))
+SEA_LION_RPM = int(os.environ.get("SEA_LION_RPM", "60"))
+SEA_LION_TPM = int(os.environ.get("SEA_LION_TPM", "0"))
+KEY_FAILURE_THRESHOLD = int(os.environ.get("KEY_FAILURE_THRESHOLD", "3"))
+KEY_COOLDOWN = float(os.environ.get("KEY_COOLDOWN", "30"))
+KEY_MAX_COOLDOWN = float(os.environ.get("KEY_MAX_COOLDOWN", "600"))
+KEY_DEFAULT_RETRY_AFTER = float(os.environ.get("KEY_DEFAULT_RETRY_AFTER", "10"))
+KEY_MAX_WAIT = float(os.environ.get("KEY_MAX_WAIT", "15"))
+# Background SRT work waits much longer for a key's RPM/TPM budget than a chat message does
+SRT_KEY_MAX_WAIT = float(os.environ.get("SRT_KEY_MAX_WAIT", "600"))
+
+# SRT limits: max cues per file (0 = unlimited), in-flight cue requests per API key, retries per cue
+SRT_MAX_ENTRIES = int(os.environ.get("SRT_MAX_ENTRIES", "2000"))
+SRT_CONCURRENCY_PER_KEY = int(os.environ.get("SRT_CONCURRENCY_PER_KEY", "2"))
+SRT_MAX_CONCURRENCY = int(os.environ.get("SRT_MAX_CONCURRENCY", "16"))
+SRT_CUE_RETRIES = int(os.environ.get("SRT_CUE_RETRIES", "2"))
+# Minimum seconds between edits of an SRT job's progress message; states in between are skipped
+PROGRESS_EDIT_INTERVAL = float(os.environ.get("PROGRESS_EDIT_INTERVAL", "3"))
+# Background SRT jobs: number of files translated at once
+SRT_WORKERS = int(os.environ.get("SRT_WORKERS", "2"))
+
+# SRT batching: pack consecutive cues into one request up to a token budget
+SRT_BATCHING = os.environ.get("SRT_BATCHING", "1") == "1"
+SRT_BATCH_TOKENS = int(os.environ.get("SRT_BATCH_TOKENS", "1200"))
+SRT_BATCH_MAX_CUES = int(os.environ.get("SRT_BATCH_MAX_CUES", "25"))
+SRT_BATCH_MAX_OUTPUT_TOKENS = int(os.environ.get("SRT_BATCH_MAX_OUTPUT_TOKENS", "4000"))
+
+# Streaming replies (opt-in): stream long translations and edit the reply progressively
+STREAM_TRANSLATIONS = os.environ.get("STREAM_TRANSLATIONS", "0") == "1"
+STREAM_MIN_CHARS = int(os.environ.get("STREAM_MIN_CHARS", "300"))
+# Seconds between message edits; Telegram allows roughly one edit per second per chat
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Long messages: split on paragraph/sentence boundaries into chunks of about this many input
+# tokens and translate them concurrently. Output budget is the input estimate times
+# TEXT_OUTPUT_RATIO, clamped between the min and max below.
+TEXT_CHUNK_TOKENS = int(os.environ.get("TEXT_CHUNK_TOKENS", "500"))
+TEXT_OUTPUT_RATIO = float(os.environ.get("TEXT_OUTPUT_RATIO", "3"))
+TEXT_MIN_OUTPUT_TOKENS = int(os.environ.get("TEXT_MIN_OUTPUT_TOKENS", "200"))
+TEXT_MAX_OUTPUT_TOKENS = int(os.environ.get("TEXT_MAX_OUTPUT_TOKENS", "2000"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Local pre-filter: answer messages with no letters, or already in the target language,
+# without an upstream call
+PREFILTER_ENABLED = os.environ.get("PREFILTER_ENABLED", "1") == "1"
+
+# Multi-target mode (/multi kh th en): most languages per message or file
+MULTI_MAX_TARGETS = int(os.environ.get("MULTI_MAX_TARGETS", "5"))
+
+# Southeast Asian languages that Sea Lion handles well; Groq serves every language
+SEA_LANGS = frozenset(["Khmer", "Thai", "Vietnamese", "Lao", "Indonesian", "Malay", "Burmese", "Filipino"])
+
+# Model routing: rolling window of latency/error samples per provider and language,
+# samples needed before stats override the default order, and share of traffic used to
+# keep the other provider's stats fresh. With hedging on, the secondary fires once the
+# primary exceeds its observed p95 latency.
+ROUTER_WINDOW = int(os.environ.get("ROUTER_WINDOW", "100"))
+ROUTER_MIN_SAMPLES = int(os.environ.get("ROUTER_MIN_SAMPLES", "10"))
+ROUTER_EXPLORE = float(os.environ.get("ROUTER_EXPLORE", "0.05"))
+ROUTER_HEDGING = os.environ.get("ROUTER_HEDGING", "0") == "1"
+ROUTER_HEDGE_DEFAULT_DELAY = float(os.environ.get("ROUTER_HEDGE_DEFAULT_DELAY", "3.0"))
+ROUTER_HEDGE_MIN_DELAY = float(os.environ.get("ROUTER_HEDGE_MIN_DELAY", "0.5"))
+
+# Outbound Telegram flood control (0 = unlimited): messages per second across the bot, per second
+# in a private chat and per minute in a group, the burst a chat may send at once, and how often a
+# call is retried after Telegram answers RetryAfter
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.environ.get("TELEGRAM_GROUP_RATE", "20"))
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", "3"))
+
+# Update processing: handlers running at once across all chats (1 = sequential); updates of
+# one chat always run in order. UPDATE_MAX_PENDING bounds updates accepted but not yet finished.
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "128"))
+UPDATE_MAX_PENDING = int(os.environ.get("UPDATE_MAX_PENDING", str(max(1, UPDATE_CONCURRENCY) * 8)))
+
+# Request scheduler: global upstream slots (0 = 4 per API key), share of slots bulk SRT work may use,
+# per-user in-flight caps per lane and optional per-user weights ("user_id:weight,...")
+SCHEDULER_CAPACITY = int(os.environ.get("SCHEDULER_CAPACITY", "0"))
+SCHEDULER_BULK_SHARE = float(os.environ.get("SCHEDULER_BULK_SHARE", "0.75"))
+USER_MAX_INTERACTIVE = int(os.environ.get("USER_MAX_INTERACTIVE", "2"))
+USER_MAX_BULK = int(os.environ.get("USER_MAX_BULK", "4"))
+USER_WEIGHTS = {
+    int(user_id): float(weight)
+    for user_id, weight in (
+        item.split(":", 1) for item in os.environ.get("USER_WEIGHTS", "").split(",") if ":" in item
+    )
+}
+
+# Translation cache: in-memory LRU in front of SQLite (TTL in seconds, sizes in entries)
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", os.path.join(DATA_DIR, "translations.db"))
+CACHE_MEMORY_SIZE = int(os.environ.get("CACHE_MEMORY_SIZE", "5000"))
+CACHE_MAX_ROWS = int(os.environ.get("CACHE_MAX_ROWS", "200000"))
+CACHE_TTL = int(os.environ.get("CACHE_TTL", str(30 * 24 * 3600)))
+# Bump whenever the prompts or output token budgets change so stale translations are not reused
+PROMPT_VERSION = "2"
+
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", os.path.join(DATA_DIR, "jobs.db"))
+
+# Translation memory for SRT cues: a stored cue with the same words, numbers and ending reuses its
+# translation; other near matches (character n-gram Jaccard) at or above TM_THRESHOLD are passed to the
+# model as reference translations, and with TM_HINTS on so are matches above TM_HINT_THRESHOLD. The MinHash index uses TM_BANDS bands of TM_ROWS hashes each.
+TM_ENABLED = os.environ.get("TM_ENABLED", "1") == "1"
+TM_DB_PATH = os.environ.get("TM_DB_PATH", os.path.join(DATA_DIR, "memory.db"))
+TM_THRESHOLD = float(os.environ.get("TM_THRESHOLD", "0.9"))
+TM_HINTS = os.environ.get("TM_HINTS", "0") == "1"
+TM_HINT_THRESHOLD = float(os.environ.get("TM_HINT_THRESHOLD", "0.6"))
+TM_BANDS = int(os.environ.get("TM_BANDS", "8"))
+TM_ROWS = int(os.environ.get("TM_ROWS", "4"))
+TM_SHINGLE_SIZE = int(os.environ.get("TM_SHINGLE_SIZE", "3"))
+TM_MAX_CANDIDATES = int(os.environ.get("TM_MAX_CANDIDATES", "20"))
+
+# User settings store: "sqlite" (default), "redis" or "memory"; writes are flushed in batches
+SETTINGS_BACKEND = os.environ.get("SETTINGS_BACKEND", "sqlite").lower()
+SETTINGS_DB_PATH = os.environ.get("SETTINGS_DB_PATH", os.path.join(DATA_DIR, "settings.db"))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+SETTINGS_FLUSH_INTERVAL = float(os.environ.get("SETTINGS_FLUSH_INTERVAL", "1.0"))
+SETTINGS_CACHE_SIZE = int(os.environ.get("SETTINGS_CACHE_SIZE", "10000"))
+# Seconds a cached setting is trusted before re-reading the shared backend
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", "60"))
+DEFAULT_LANG = "kh"
+
+# Request tracing: per-stage timings of each handled message, SRT upload and SRT job. The slowest
+# TRACE_SLOW_KEEP of each handler are served on /debug/slow; handler traces above TRACE_LOG_THRESHOLD
+# seconds are logged, background SRT jobs (minutes long by design) above TRACE_JOB_LOG_THRESHOLD.
+# The /debug routes answer 404 unless DEBUG_TOKEN is set, and then require it as X-Debug-Token (or ?token=).
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "1") == "1"
+TRACE_SLOW_KEEP = int(os.environ.get("TRACE_SLOW_KEEP", "50"))
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", "200"))
+TRACE_LOG_THRESHOLD = float(os.environ.get("TRACE_LOG_THRESHOLD", "10"))
+TRACE_JOB_LOG_THRESHOLD = float(os.environ.get("TRACE_JOB_LOG_THRESHOLD", "1800"))
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN", "")
+
+# Telegram user ids allowed to run admin commands (/profile)
+ADMIN_USER_IDS = frozenset(
+    int(user_id) for user_id in os.environ.get("ADMIN_USER_IDS", "").split(",") if user_id.strip().isdigit()
+)
+# /profile sampling profiler: seconds between stack samples, longest run and output directory
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "120"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+
+# --- Metrics ---
+LLM_LATENCY = Histogram(
+    "translatebot_llm_request_seconds", "Upstream chat-completion latency",
+    ["provider", "model", "key"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 30, 60)
+)
+LLM_ERRORS = Counter(
+    "translatebot_llm_errors_total", "Failed upstream requests", ["provider", "model", "key", "status"]
+)
+LLM_RATE_LIMITED = Counter(
+    "translatebot_llm_rate_limited_total", "Upstream 429 responses", ["provider", "model", "key"]
+)
+LLM_TOKENS = Counter(
+    "translatebot_llm_tokens_total", "Tokens reported by response.usage", ["provider", "model", "kind"]
+)
+LLM_IN_FLIGHT = Gauge(
+    "translatebot_llm_in_flight_requests", "Upstream requests currently in flight", ["provider"]
+)
+SRT_CUES_PROCESSED = Counter("translatebot_srt_cues_processed_total", "SRT cues translated or served from cache")
+HEDGED_REQUESTS = Counter(
+    "translatebot_hedged_requests_total", "Requests where the secondary provider was fired", ["winner"]
+)
+COALESCED_REQUESTS = Counter(
+    "translatebot_coalesced_requests_total", "Translations that joined an identical in-flight request"
+)
+CACHE_LOOKUPS = Counter("translatebot_cache_lookups_total", "Translation cache lookups", ["result"])
+CACHE_HIT_RATIO = Gauge("translatebot_cache_hit_ratio", "Translation cache hit ratio since start")
+PREFILTER_SKIPS = Counter(
+    "translatebot_prefilter_skips_total", "Translations answered locally by the language pre-filter", ["reason"]
+)
+TM_LOOKUPS = Counter("translatebot_tm_lookups_total", "Translation memory lookups", ["result"])
+EVENT_LOOP_LAG = Gauge("translatebot_event_loop_lag_seconds", "Latest measured event-loop scheduling delay")
+EVENT_LOOP_LAG_HISTOGRAM = Histogram(
+    "translatebot_event_loop_lag_distribution_seconds", "Event-loop scheduling delay",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+SCHEDULER_WAIT = Histogram(
+    "translatebot_scheduler_wait_seconds", "Time spent queued for an upstream slot", ["lane"],
+    buckets=(0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+SCHEDULER_QUEUED = Gauge("translatebot_scheduler_queued", "Requests waiting for an upstream slot", ["lane"])
+SCHEDULER_ACTIVE = Gauge("translatebot_scheduler_active", "Upstream slots in use", ["lane"])
+UPDATES_ACTIVE = Gauge("translatebot_updates_active", "Telegram updates being handled")
+UPDATES_WAITING = Gauge("translatebot_updates_waiting", "Telegram updates waiting for their chat or a handler slot")
+TELEGRAM_THROTTLED = Histogram(
+    "translatebot_telegram_throttle_seconds", "Time outbound Bot API calls waited for flood control",
+    ["endpoint"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+TELEGRAM_RETRY_AFTER = Counter(
+    "translatebot_telegram_retry_after_total", "RetryAfter answers from the Bot API", ["endpoint"]
+)
+PROGRESS_EDITS = Counter(
+    "translatebot_progress_edits_total", "Progress message updates", ["result"]
+)
+REQUEST_STAGE_SECONDS = Histogram(
+    "translatebot_request_stage_seconds", "Time spent per request in each traced stage", ["handler", "stage"],
+    buckets=(0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+EVENT_LOOP_LAG_INTERVAL = float(os.environ.get("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+
+def record_llm_usage(provider, response):
+    """Add prompt/completion token counts from response.usage"""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    LLM_TOKENS.labels(provider.name, provider.model, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+    LLM_TOKENS.labels(provider.name, provider.model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+    return getattr(usage, "total_tokens", None)
+
+def record_llm_error(provider, key, error):
+    status_code = getattr(error, "status_code", None)
+    LLM_ERRORS.labels(provider.name, provider.model, key.label, str(status_code or type(error).__name__)).inc()
+    if status_code == 429:
+        LLM_RATE_LIMITED.labels(provider.name, provider.model, key.label).inc()
+
+async def monitor_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL):
+    """Measure how late the loop wakes a sleeping task"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        EVENT_LOOP_LAG.set(lag)
+        EVENT_LOOP_LAG_HISTOGRAM.observe(lag)
+
+# --- Request tracing ---
+# The trace of the handler or job running in the current task; tasks it spawns inherit it
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class RequestTrace:
+    """Stage timings of one handled update or SRT job"""
+    __slots__ = ("name", "user_id", "started_at", "started", "duration", "spans", "totals", "dropped", "error")
+
+    def __init__(self, name, user_id=None):
+        self.name = name
+        self.user_id = user_id
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []  # (stage, offset, duration, error), the first TRACE_MAX_SPANS only
+        # Seconds per stage over all spans; concurrent spans of one stage (e.g. parallel chunks) add up
+        self.totals = defaultdict(float)
+        self.dropped = 0
+        self.error = None
+
+    def add_span(self, stage, started, duration, error=None):
+        self.totals[stage] += duration
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append((stage, started - self.started, duration, error))
+
+    def to_dict(self):
+        return {
+            "handler": self.name,
+            "user_id": self.user_id,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+            "duration_ms": round((self.duration or 0.0) * 1000, 1),
+            "error": self.error,
+            "stages_ms": {stage: round(total * 1000, 1) for stage, total in self.totals.items()},
+            "spans": [
+                {"stage": stage, "start_ms": round(offset * 1000, 1), "ms": round(duration * 1000, 1), "error": error}
+                for stage, offset, duration, error in self.spans
+            ],
+            "dropped_spans": self.dropped
+        }
+
+class SlowRequestLog:
+    """The slowest `keep` finished traces per handler, each in a min-heap so its fastest is evicted first
+
+    Separate heaps keep minutes-long SRT jobs from pushing every message trace out.
+    """
+
+    def __init__(self, keep=TRACE_SLOW_KEEP):
+        self.keep = keep
+        self._heaps = defaultdict(list)
+        self._sequence = itertools.count()
+        self.recorded = 0
+
+    def add(self, trace):
+        self.recorded += 1
+        heap = self._heaps[trace.name]
+        item = (trace.duration, next(self._sequence), trace)
+        if len(heap) < self.keep:
+            heapq.heappush(heap, item)
+        elif item[0] > heap[0][0]:
+            heapq.heapreplace(heap, item)
+
+    def snapshot(self, handler=None):
+        """Slowest first, optionally only one handler's traces"""
+        if handler is None:
+            items = [item for heap in self._heaps.values() for item in heap]
+        else:
+            items = self._heaps.get(handler, [])
+        return [trace.to_dict() for _, _, trace in sorted(items, reverse=True)]
+
+    def clear(self):
+        self._heaps.clear()
+
+slow_requests = SlowRequestLog()
+
+@contextlib.contextmanager
+def trace_span(stage):
+    """Time one stage of the current request; a no-op outside a traced handler or job"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add_span(stage, started, time.perf_counter() - started, error)
+
+@contextlib.contextmanager
+def request_trace(name, user_id=None, log_threshold=TRACE_LOG_THRESHOLD):
+    """Trace the block as one request: export stage timings and keep it if among the slowest"""
+    if not TRACE_ENABLED:
+        yield None
+        return
+    trace = RequestTrace(name, user_id)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.error = type(e).__name__
+        raise
+    finally:
+        current_trace.reset(token)
+        trace.duration = time.perf_counter() - trace.started
+        totals = trace.totals
+        for stage, total in totals.items():
+            REQUEST_STAGE_SECONDS.labels(name, stage).observe(total)
+        REQUEST_STAGE_SECONDS.labels(name, "total").observe(trace.duration)
+        slow_requests.add(trace)
+        if trace.duration >= log_threshold:
+            stages = ", ".join(f"{stage} {total:.2f}s" for stage, total in sorted(totals.items(), key=lambda x: -x[1]))
+            logger.warning(f"🐢 {name} for user {user_id} took {trace.duration:.2f}s ({stages})")
+
+def traced(name):
+    """Decorator tracing every call of a Telegram handler as request `name`"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            user = getattr(update, "effective_user", None)
+            with request_trace(name, user.id if user else None):
+                return await handler(update, context)
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    """Time-boxed sampling profiler writing collapsed stacks for flamegraph.pl / speedscope
+
+    A background thread snapshots every thread's Python stack each `interval` seconds. No hooks
+    are installed, so the bot runs at full speed when it is idle and close to it while it samples.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, directory=PROFILE_DIR):
+        self.interval = interval
+        self.directory = directory
+        self.running = False
+
+    def _sample(self, seconds):
+        own = threading.get_ident()
+        names = {}
+        stacks = defaultdict(int)
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, samples
+
+    def _write(self, stacks):
+        data = "".join(
+            f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda x: -x[1])
+        ).encode("utf-8")
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S.folded", time.gmtime()))
+        with open(path, "wb") as f:
+            f.write(data)
+        return path, data
+
+    async def run(self, seconds):
+        """Sample for `seconds`; returns (path of the collapsed-stack file, its contents, samples taken)"""
+        self.running = True
+        try:
+            logger.info(f"🔬 Profiling for {seconds:g}s")
+            stacks, samples = await asyncio.to_thread(self._sample, seconds)
+            path, data = await asyncio.to_thread(self._write, stacks)
+        finally:
+            self.running = False
+        logger.info(f"🔬 Profile written to {path} ({samples} samples)")
+        return path, data, samples
+
+profiler = SamplingProfiler()
+
+class NoClientAvailable(Exception):
+    """Raised when no provider has a usable API client"""
+
+class KeyPoolExhausted(Exception):
+    """Raised when every key of a provider is rate limited or broken for too long"""
+
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute` tokens per minute (0 = unlimited)
+
+    It holds at most `burst` tokens, a full minute's worth by default.
+    """
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst or per_minute) if per_minute else 0.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def headroom(self, now):
+        """Fraction of the bucket currently available (1.0 when unlimited)"""
+        if not self.capacity:
+            return 1.0
+        self._refill(now)
+        return max(self.tokens, 0.0) / self.capacity
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` tokens are available"""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount, now):
+        if self.capacity:
+            self._refill(now)
+            self.tokens -= amount
+
+    def refund(self, amount):
+        if self.capacity:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+class CircuitBreaker:
+    """Per-key circuit breaker: opens after repeated failures, half-opens after a cooldown"""
+
+    def __init__(self, threshold=KEY_FAILURE_THRESHOLD, cooldown=KEY_COOLDOWN, max_cooldown=KEY_MAX_COOLDOWN):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.trips = 0
+        self.state = "closed"
+        self.open_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds until the breaker lets a request through"""
+        if self.state == "open":
+            return max(0.0, self.open_until - now)
+        return 0.0
+
+    def on_attempt(self, now):
+        if self.state == "open" and now >= self.open_until:
+            # Let one trial request through
+            self.state = "half_open"
+
+    def record_success(self):
+        self.failures = 0
+        self.trips = 0
+        self.state = "closed"
+
+    def record_failure(self, now, trip=False):
+        self.failures += 1
+        if trip or self.state == "half_open" or self.failures >= self.threshold:
+            self.trips += 1
+            cooldown = min(self.max_cooldown, self.base_cooldown * 2 ** (self.trips - 1))
+            self.state = "open"
+            self.open_until = now + cooldown
+            self.failures = 0
+            return cooldown
+        return 0.0
+
+class PooledKey:
+    """Scheduling state for one API key"""
+
+    def __init__(self, label, api_key, client_factory, rpm, tpm):
+        self.label = label
+        self.api_key = api_key
+        self.client_factory = client_factory
+        self._client = None
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.breaker = CircuitBreaker()
+        self.retry_until = 0.0
+        self.in_flight = 0
+
+    @property
+    def client(self):
+        """The API client for this key, built on first use to keep startup fast"""
+        if self._client is None:
+            self._client = self.client_factory(self.api_key)
+            logger.info(f"✅ {self.label} client initialized")
+        return self._client
+
+    def wait_time(self, estimated_tokens, now):
+        """Seconds until this key can take a request of `estimated_tokens`"""
+        if self.breaker.state == "half_open" and self.in_flight:
+            return KEY_COOLDOWN  # a trial request is already running
+        return max(
+            self.retry_until - now,
+            self.breaker.wait_time(now),
+            self.requests.wait_time(1, now),
+            self.tokens.wait_time(estimated_tokens, now)
+        )
+
+    def headroom(self, now):
+        return min(self.requests.headroom(now), self.tokens.headroom(now)) / (1 + self.in_flight)
+
+    def snapshot(self, now):
+        return {
+            "key": self.label,
+            "state": self.breaker.state,
+            "in_flight": self.in_flight,
+            "rpm_headroom": round(self.requests.headroom(now), 2),
+            "tpm_headroom": round(self.tokens.headroom(now), 2),
+            "retry_after": round(max(0.0, self.retry_until - now), 1)
+        }
+
+def retry_after_seconds(error):
+    """Read the retry-after header from an API error, if any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after")
+    if value is None and headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers.get("retry-after-ms")) / 1000.0
+        except ValueError:
+            return None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+class KeyPool:
+    """Rate-limit-aware key scheduler: picks the key with the most headroom"""
+
+    def __init__(self, name, api_keys, client_factory, rpm, tpm):
+        self.name = name
+        self.keys = [
+            PooledKey(f"{name}#{i+1}", api_key, client_factory, rpm, tpm) for i, api_key in enumerate(api_keys)
+        ]
+
+    async def acquire(self, estimated_tokens, max_wait=KEY_MAX_WAIT):
+        """Reserve the best available key, waiting up to max_wait seconds for one to free up"""
+        deadline = time.monotonic() + max_wait
+        while True:
+            now = time.monotonic()
+            best = None
+            shortest_wait = None
+            for key in self.keys:
+                wait = key.wait_time(estimated_tokens, now)
+                if wait <= 0:
+                    if best is None or key.headroom(now) > best.headroom(now):
+                        best = key
+                elif shortest_wait is None or wait < shortest_wait:
+                    shortest_wait = wait
+
+            if best is not None:
+                best.breaker.on_attempt(now)
+                best.requests.consume(1, now)
+                best.tokens.consume(estimated_tokens, now)
+                best.in_flight += 1
+                return best
+
+            if shortest_wait is None or now + shortest_wait > deadline:
+                raise KeyPoolExhausted(f"All {self.name} keys are rate limited or unavailable")
+            await asyncio.sleep(min(shortest_wait, 1.0))
+
+    def release(self, key, estimated_tokens, used_tokens=None, error=None, cancelled=False):
+        """Return a key after a request, updating its buckets and breaker"""
+        now = time.monotonic()
+        key.in_flight -= 1
+        if cancelled:
+            return  # e.g. the losing side of a hedged request; says nothing about the key
+        if error is None:
+            key.breaker.record_success()
+            if used_tokens is not None:
+                key.tokens.refund(estimated_tokens - used_tokens)
+            return
+
+        status_code = getattr(error, "status_code", None)
+        if status_code == 429:
+            retry_after = retry_after_seconds(error) or KEY_DEFAULT_RETRY_AFTER
+            key.retry_until = max(key.retry_until, now + retry_after)
+            key.breaker.record_failure(now)
+            logger.warning(f"⏳ {key.label} rate limited, retry after {retry_after:.1f}s")
+        elif status_code in (401, 403):
+            # Expired or revoked key: take it out of rotation straight away
+            cooldown = key.breaker.record_failure(now, trip=True)
+            logger.error(f"🔒 {key.label} rejected ({status_code}), disabled for {cooldown:.0f}s")
+        else:
+            cooldown = key.breaker.record_failure(now)
+            if cooldown:
+                logger.warning(f"⚡ {key.label} circuit open for {cooldown:.0f}s after repeated failures")
+
+    def snapshot(self):
+        now = time.monotonic()
+        return [key.snapshot(now) for key in self.keys]
+
+class AIProvider:
+    """Async chat-completion provider with one pooled HTTP client per API key"""
+
+    def __init__(self, name, model, keys, client_factory, temperature=0.2, system_role=True, rpm=0, tpm=0):
+        self.name = name
+        self.model = model
+        self.temperature = temperature
+        # Gemma based models (Sea Lion) reject the "system" role
+        self.system_role = system_role
+        self.client_factory = client_factory
+        # Clients (and their HTTP pools) are created lazily by each key on first use
+        self.pool = KeyPool(name, keys, self._build_client, rpm, tpm)
+
+    def _build_client(self, api_key):
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_CONNECTIONS
+            )
+        )
+        return self.client_factory(api_key, http_client)
+
+    @property
+    def key_count(self):
+        return len(self.pool.keys)
+
+    def clients_initialized(self):
+        """Number of keys whose client has been built so far"""
+        return sum(1 for key in self.pool.keys if key._client is not None)
+
+    async def complete(self, messages, max_tokens=200, max_wait=KEY_MAX_WAIT):
+        """Run one chat completion on the key with the most headroom and return the stripped text"""
+        if not self.key_count:
+            raise NoClientAvailable(f"No {self.name} client available")
+        estimated_tokens = sum(estimate_tokens(m["content"]) for m in messages) + max_tokens
+        key = await self.pool.acquire(estimated_tokens, max_wait=max_wait)
+        in_flight = LLM_IN_FLIGHT.labels(self.name)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            response = await key.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=max_tokens
+            )
+        except asyncio.CancelledError:
+            self.pool.release(key, estimated_tokens, cancelled=True)
+            raise
+        except Exception as e:
+            record_llm_error(self, key, e)
+            self.pool.release(key, estimated_tokens, error=e)
+            raise
+        finally:
+            in_flight.dec()
+            LLM_LATENCY.labels(self.name, self.model, key.label).observe(time.perf_counter() - started)
+        self.pool.release(key, estimated_tokens, used_tokens=record_llm_usage(self, response))
+        return response.choices[0].message.content.strip()
+
+    async def stream(self, messages, max_tokens=200, max_wait=KEY_MAX_WAIT):
+        """Run one streamed chat completion, yielding text deltas as they arrive"""
+        if not self.key_count:
+            raise NoClientAvailable(f"No {self.name} client available")
+        estimated_tokens = sum(estimate_tokens(m["content"]) for m in messages) + max_tokens
+        key = await self.pool.acquire(estimated_tokens, max_wait=max_wait)
+        in_flight = LLM_IN_FLIGHT.labels(self.name)
+        in_flight.inc()
+        started = time.perf_counter()
+        error = None
+        cancelled = True  # cleared once the stream finishes or fails normally
+        try:
+            response = await key.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+            cancelled = False
+        except Exception as e:
+            error = e
+            cancelled = False
+            record_llm_error(self, key, e)
+            raise
+        finally:
+            in_flight.dec()
+            LLM_LATENCY.labels(self.name, self.model, key.label).observe(time.perf_counter() - started)
+            self.pool.release(key, estimated_tokens, error=error, cancelled=cancelled)
+
+    async def aclose(self):
+        """Close the pooled HTTP connections"""
+        for key in self.pool.keys:
+            if key._client is None:
+                continue
+            try:
+                await key._client.close()
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to close {self.name} client: {e}")
+
+groq_provider = AIProvider(
+    "Groq", GROQ_MODEL, GROQ_KEYS,
+    lambda api_key, http_client: AsyncGroq(
+        api_key=api_key, base_url=GROQ_BASE_URL, http_client=http_client,
+        timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES
+    ),
+    temperature=0.2,
+    rpm=GROQ_RPM,
+    tpm=GROQ_TPM
+)
+
+sealion_provider = AIProvider(
+    "Sea Lion", SEA_LION_MODEL, SEA_KEYS,
+    lambda api_key, http_client: AsyncOpenAI(
+        base_url=SEA_LION_BASE_URL, api_key=api_key, http_client=http_client,
+        timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES
+    ),
+    temperature=0.3,
+    system_role=False,
+    rpm=SEA_LION_RPM,
+    tpm=SEA_LION_TPM
+)
+
+
+# --- Request scheduler ---
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+
+class _SlotRequest:
+    """A queued request for an upstream slot"""
+    __slots__ = ("user_id", "lane", "finish_tag", "future", "queued_at")
+
+    def __init__(self, user_id, lane, finish_tag, future):
+        self.user_id = user_id
+        self.lane = lane
+        self.finish_tag = finish_tag
+        self.future = future
+        self.queued_at = time.monotonic()
+
+class FairScheduler:
+    """Upstream slot scheduler with priority lanes and per-user weighted fair queueing
+
+    Interactive requests are always served before bulk ones and bulk work may only hold
+    `bulk_share` of the slots, so chat messages keep headroom while SRT files run. Inside a
+    lane, users are ordered by virtual finish time (cost / weight), so one user's backlog
+    cannot starve the others, and each user is capped at a number of in-flight requests.
+    """
+
+    def __init__(self, capacity, bulk_share=SCHEDULER_BULK_SHARE,
+                 user_caps=None, weights=None):
+        self.capacity = max(1, capacity)
+        self.bulk_limit = max(1, int(self.capacity * bulk_share))
+        self.user_caps = user_caps or {LANE_INTERACTIVE: USER_MAX_INTERACTIVE, LANE_BULK: USER_MAX_BULK}
+        self.weights = weights if weights is not None else USER_WEIGHTS
+        self._queues = {LANE_INTERACTIVE: [], LANE_BULK: []}
+        self._active = {LANE_INTERACTIVE: 0, LANE_BULK: 0}
+        self._user_active = defaultdict(int)
+        self._finish_tags = {}
+        self._virtual_time = {LANE_INTERACTIVE: 0.0, LANE_BULK: 0.0}
+        self._sequence = itertools.count()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, lane=LANE_INTERACTIVE, cost=1.0):
+        """Hold one upstream slot for the duration of the block"""
+        request = self._enqueue(user_id, lane, cost)
+        self._dispatch()
+        with trace_span("scheduler_wait"):
+            try:
+                await request.future
+            except asyncio.CancelledError:
+                if request.future.done() and not request.future.cancelled():
+                    self._release(request)  # granted just before the cancel arrived
+                self._dispatch()
+                raise
+        SCHEDULER_WAIT.labels(lane).observe(time.monotonic() - request.queued_at)
+        try:
+            yield
+        finally:
+            self._release(request)
+
+    def _enqueue(self, user_id, lane, cost):
+        weight = self.weights.get(user_id, 1.0) or 1.0
+        key = (lane, user_id)
+        start_tag = max(self._virtual_time[lane], self._finish_tags.get(key, 0.0))
+        finish_tag = start_tag + max(cost, 1.0) / weight
+        self._finish_tags[key] = finish_tag
+        request = _SlotRequest(user_id, lane, finish_tag, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queues[lane], (finish_tag, next(self._sequence), request))
+        SCHEDULER_QUEUED.labels(lane).inc()
+        return request
+
+    def _pick(self, lane):
+        """Pop the eligible request with the smallest finish tag, skipping users at their cap"""
+        queue = self._queues[lane]
+        skipped = []
+        picked = None
+        while queue:
+            item = heapq.heappop(queue)
+            request = item[2]
+            if request.future.done():
+                SCHEDULER_QUEUED.labels(lane).dec()  # cancelled while waiting
+                continue
+            if self._user_active[(lane, request.user_id)] >= self.user_caps[lane]:
+                skipped.append(item)
+                continue
+            picked = request
+            break
+        for item in skipped:
+            heapq.heappush(queue, item)
+        return picked
+
+    def _dispatch(self):
+        while sum(self._active.values()) < self.capacity:
+            request = self._pick(LANE_INTERACTIVE)
+            if request is None and self._active[LANE_BULK] < self.bulk_limit:
+                request = self._pick(LANE_BULK)
+            if request is None:
+                break
+            lane = request.lane
+            self._active[lane] += 1
+            self._user_active[(lane, request.user_id)] += 1
+            self._virtual_time[lane] = max(self._virtual_time[lane], request.finish_tag - 1e-9)
+            SCHEDULER_QUEUED.labels(lane).dec()
+            SCHEDULER_ACTIVE.labels(lane).inc()
+            request.future.set_result(None)
+
+    def _release(self, request):
+        lane = request.lane
+        key = (lane, request.user_id)
+        self._active[lane] -= 1
+        self._user_active[key] -= 1
+        if not self._user_active[key]:
+            del self._user_active[key]
+            # Forget idle users whose tags are already in the past
+            if self._finish_tags.get(key, 0.0) <= self._virtual_time[lane]:
+                self._finish_tags.pop(key, None)
+        SCHEDULER_ACTIVE.labels(lane).dec()
+        self._dispatch()
+
+    def snapshot(self):
+        return {
+            "capacity": self.capacity,
+            "bulk_limit": self.bulk_limit,
+            "active": dict(self._active),
+            "queued": {lane: len(queue) for lane, queue in self._queues.items()}
+        }
+
+def scheduler_capacity():
+    """Global upstream slots: SCHEDULER_CAPACITY, or 4 per configured API key"""
+    if SCHEDULER_CAPACITY:
+        return SCHEDULER_CAPACITY
+    return max(4, 4 * (groq_provider.key_count + sealion_provider.key_count))
+
+request_scheduler = FairScheduler(scheduler_capacity())
+
+# --- Translation cache ---
+class TranslationCache:
+    """Two-tier translation cache: bounded in-memory LRU backed by a SQLite table"""
+
+    PRUNE_EVERY = 500  # writes between TTL/size pruning passes
+
+    def __init__(self, path, memory_size, max_rows, ttl):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text, target_lang, model, mode="text"):
+        """Cache key over normalized text, target language, model, mode and prompt version"""
+        normalized = unicodedata.normalize("NFC", text).strip()
+        normalized = re.sub(r'[ \t]+', ' ', normalized)
+        raw = "\x00".join((PROMPT_VERSION, model, target_lang, mode, normalized))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_translations_created ON translations(created_at)")
+            self._db.commit()
+        return self._db
+
+    def _remember(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _memory_get(self, key, now):
+        item = self._memory.get(key)
+        if item is None:
+            return None
+        value, created_at = item
+        if now - created_at > self.ttl:
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return value
+
+    def _disk_get_many(self, keys):
+        with self._db_lock:
+            db = self._connect()
+            found = {}
+            # Stay well below SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = db.execute(
+                    f"SELECT key, value, created_at FROM translations WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, value, created_at in rows:
+                    found[key] = (value, created_at)
+            return found
+
+    def _disk_set_many(self, items, created_at):
+        with self._db_lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO translations (key, value, created_at) VALUES (?, ?, ?)",
+                [(key, value, created_at) for key, value in items]
+            )
+            previous = self._writes
+            self._writes += len(items)
+            if self._writes // self.PRUNE_EVERY != previous // self.PRUNE_EVERY:
+                self._prune(db)
+            db.commit()
+
+    def _prune(self, db):
+        """Drop expired rows, then the oldest rows beyond max_rows"""
+        db.execute("DELETE FROM translations WHERE created_at < ?", (time.time() - self.ttl,))
+        (count,) = db.execute("SELECT COUNT(*) FROM translations").fetchone()
+        if count > self.max_rows:
+            db.execute(
+                "DELETE FROM translations WHERE key IN ("
+                "SELECT key FROM translations ORDER BY created_at LIMIT ?)",
+                (count - self.max_rows,)
+            )
+
+    async def get_many(self, keys):
+        """Look up several keys, returning {key: value} for the hits"""
+        now = time.time()
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._memory_get(key, now)
+            if value is not None:
+                found[key] = value
+                self.memory_hits += 1
+                CACHE_LOOKUPS.labels("memory_hit").inc()
+            else:
+                missing.append(key)
+
+        if missing:
+            try:
+                rows = await asyncio.to_thread(self._disk_get_many, missing)
+            except Exception as e:
+                logger.warning(f"⚠️ Cache read failed: {e}")
+                rows = {}
+            for key in missing:
+                row = rows.get(key)
+                if row and now - row[1] <= self.ttl:
+                    found[key] = row[0]
+                    self._remember(key, row[0], row[1])
+                    self.disk_hits += 1
+                    CACHE_LOOKUPS.labels("disk_hit").inc()
+                else:
+                    self.misses += 1
+                    CACHE_LOOKUPS.labels("miss").inc()
+        return found
+
+    async def get(self, key):
+        """Look up one key, returning None on a miss"""
+        return (await self.get_many([key])).get(key)
+
+    async def set(self, key, value):
+        """Store a translation in memory and on disk"""
+        await self.set_many({key: value})
+
+    async def set_many(self, items):
+        """Store {key: value} translations in memory and on disk in one transaction"""
+        if not items:
+            return
+        now = time.time()
+        for key, value in items.items():
+            self._remember(key, value, now)
+        try:
+            await asyncio.to_thread(self._disk_set_many, list(items.items()), now)
+        except Exception as e:
+            logger.warning(f"⚠️ Cache write failed: {e}")
+
+    def stats(self):
+        """Hit/miss counters for /status"""
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "memory_entries": len(self._memory)
+        }
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+translation_cache = TranslationCache(CACHE_DB_PATH, CACHE_MEMORY_SIZE, CACHE_MAX_ROWS, CACHE_TTL)
+CACHE_HIT_RATIO.set_function(lambda: translation_cache.stats()["hit_rate"])
+
+# --- Translation memory ---
+class MemoryMatch(NamedTuple):
+    source: str
+    translation: str
+    similarity: float
+
+class TranslationMemory:
+    """Persistent fuzzy translation memory for subtitle cues, indexed with MinHash LSH in SQLite
+
+    Each cue is shingled into character n-grams (so scripts without spaces work too) and its
+    MinHash signature is cut into bands; every band is stored as one indexed 64-bit key. A lookup
+    only reads segments sharing a band with the query, so it stays fast as the memory grows.
+    """
+
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, path, bands, rows, shingle_size, max_candidates):
+        self.path = path
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        self.max_candidates = max_candidates
+        # Fixed seed: signatures must stay comparable across restarts
+        rng = random.Random(0x7A5E)
+        self._permutations = [
+            (rng.randrange(1, self.PRIME), rng.randrange(0, self.PRIME)) for _ in range(bands * rows)
+        ]
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.lookups = dict.fromkeys(("exact", "fuzzy", "hint", "miss"), 0)
+
+    @staticmethod
+    def normalize(text):
+        text = unicodedata.normalize("NFC", text).casefold()
+        return re.sub(r'\s+', ' ', text).strip()
+
+    def shingles(self, normalized):
+        # Most punctuation, full stops included, rarely changes a subtitle's translation; ?, ! and … do
+        padded = " " + re.sub(r'[^\w\s?!…]+', '', normalized.replace("...", "…")).strip() + " "
+        if len(padded) <= self.shingle_size:
+            return {padded}
+        return {padded[i:i + self.shingle_size] for i in range(len(padded) - self.shingle_size + 1)}
+
+    def band_keys(self, target_lang, shingles):
+        """LSH band keys for a shingle set, scoped to the target language"""
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for shingle in shingles
+        ]
+        signature = [min((a * h + b) % self.PRIME for h in hashes) for a, b in self._permutations]
+        keys = []
+        for band in range(self.bands):
+            rows = signature[band * self.rows:(band + 1) * self.rows]
+            raw = f"{target_lang}\x00{band}\x00{rows}".encode("utf-8")
+            keys.append(int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), "big", signed=True))
+        return keys
+
+    @staticmethod
+    def similarity(a, b):
+        return len(a & b) / len(a | b) if a or b else 1.0
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tm_segments ("
+                "id INTEGER PRIMARY KEY, target_lang TEXT NOT NULL, normalized TEXT NOT NULL, "
+                "source TEXT NOT NULL, translation TEXT NOT NULL, created_at REAL NOT NULL, "
+                "UNIQUE (target_lang, normalized))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tm_bands ("
+                "band INTEGER NOT NULL, segment_id INTEGER NOT NULL, "
+                "PRIMARY KEY (band, segment_id)) WITHOUT ROWID"
+            )
+            self._db.commit()
+        return self._db
+
+    def _lookup_many(self, texts, target_lang):
+        matches = {}
+        with self._db_lock:
+            db = self._connect()
+            for text in texts:
+                normalized = self.normalize(text)
+                if not normalized:
+                    continue
+                row = db.execute(
+                    "SELECT source, translation FROM tm_segments WHERE target_lang = ? AND normalized = ?",
+                    (target_lang, normalized)
+                ).fetchone()
+                if row:
+                    matches[text] = MemoryMatch(row[0], row[1], 1.0)
+                    continue
+
+                shingles = self.shingles(normalized)
+                keys = self.band_keys(target_lang, shingles)
+                # Segments sharing the most bands are the likeliest near-duplicates
+                rows = db.execute(
+                    "SELECT s.source, s.normalized, s.translation FROM tm_segments s JOIN ("
+                    f"SELECT segment_id, COUNT(*) AS shared FROM tm_bands WHERE band IN ({','.join('?' * len(keys))}) "
+                    "GROUP BY segment_id ORDER BY shared DESC LIMIT ?) c ON s.id = c.segment_id",
+                    (*keys, self.max_candidates)
+                ).fetchall()
+                best = None
+                for source, candidate, translation in rows:
+                    score = self.similarity(shingles, self.shingles(candidate))
+                    if best is None or score > best.similarity:
+                        best = MemoryMatch(source, translation, score)
+                if best is not None:
+                    matches[text] = best
+        return matches
+
+    def _add_many(self, pairs, target_lang):
+        now = time.time()
+        with self._db_lock:
+            db = self._connect()
+            for source, translation in pairs:
+                normalized = self.normalize(source)
+                if not normalized:
+                    continue
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO tm_segments (target_lang, normalized, source, translation, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (target_lang, normalized, source, translation, now)
+                )
+                if cursor.rowcount:
+                    db.executemany(
+                        "INSERT OR IGNORE INTO tm_bands (band, segment_id) VALUES (?, ?)",
+                        [(key, cursor.lastrowid) for key in self.band_keys(target_lang, self.shingles(normalized))]
+                    )
+                else:
+                    db.execute(
+                        "UPDATE tm_segments SET source = ?, translation = ?, created_at = ? "
+                        "WHERE target_lang = ? AND normalized = ?",
+                        (source, translation, now, target_lang, normalized)
+                    )
+            db.commit()
+
+    async def lookup_many(self, texts, target_lang):
+        """Best stored match per text as {text: MemoryMatch}; texts without candidates are left out"""
+        try:
+            return await asyncio.to_thread(self._lookup_many, texts, target_lang)
+        except Exception as e:
+            logger.warning(f"⚠️ Translation memory read failed: {e}")
+            return {}
+
+    async def add_many(self, pairs, target_lang):
+        """Remember (source, translation) pairs"""
+        if not pairs:
+            return
+        try:
+            await asyncio.to_thread(self._add_many, pairs, target_lang)
+        except Exception as e:
+            logger.warning(f"⚠️ Translation memory write failed: {e}")
+
+    def record(self, result, count=1):
+        """Count lookup outcomes: exact, fuzzy, hint or miss"""
+        self.lookups[result] += count
+        TM_LOOKUPS.labels(result).inc(count)
+
+    def stats(self):
+        """Lookup counters for /status"""
+        return dict(self.lookups)
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+translation_memory = (
+    TranslationMemory(TM_DB_PATH, TM_BANDS, TM_ROWS, TM_SHINGLE_SIZE, TM_MAX_CANDIDATES) if TM_ENABLED else None
+)
+
+# --- User settings store ---
+class SettingsBackend:
+    """Persistent storage for per-user settings dicts"""
+
+    async def load(self, user_id):
+        """Return the stored settings dict, or None"""
+        raise NotImplementedError
+
+    async def save_many(self, items):
+        """Persist {user_id: settings} in one batch"""
+        raise NotImplementedError
+
+    async def count(self):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class MemorySettingsBackend(SettingsBackend):
+    """Process-local backend (settings are lost on restart)"""
+
+    def __init__(self):
+        self._data = {}
+
+    async def load(self, user_id):
+        return self._data.get(user_id)
+
+    async def save_many(self, items):
+        self._data.update(items)
+
+    async def count(self):
+        return len(self._data)
+
+class SQLiteSettingsBackend(SettingsBackend):
+    """SQLite backend; queries run in a worker thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS user_settings ("
+                "user_id INTEGER PRIMARY KEY, settings TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _load(self, user_id):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT settings FROM user_settings WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save_many(self, items):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO user_settings (user_id, settings, updated_at) VALUES (?, ?, ?)",
+                [(user_id, json.dumps(settings), now) for user_id, settings in items.items()]
+            )
+            db.commit()
+
+    def _count(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM user_settings").fetchone()[0]
+
+    async def load(self, user_id):
+        return await asyncio.to_thread(self._load, user_id)
+
+    async def save_many(self, items):
+        await asyncio.to_thread(self._save_many, items)
+
+    async def count(self):
+        return await asyncio.to_thread(self._count)
+
+    async def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class RedisSettingsBackend(SettingsBackend):
+    """Redis-compatible backend storing settings as JSON in one hash"""
+
+    KEY = "translatebot:user_settings"
+
+    def __init__(self, url):
+        self._redis = aioredis.from_url(url, decode_responses=True)
+
+    async def load(self, user_id):
+        value = await self._redis.hget(self.KEY, str(user_id))
+        return json.loads(value) if value else None
+
+    async def save_many(self, items):
+        await self._redis.hset(self.KEY, mapping={
+            str(user_id): json.dumps(settings) for user_id, settings in items.items()
+        })
+
+    async def count(self):
+        return await self._redis.hlen(self.KEY)
+
+    async def close(self):
+        await self._redis.close()
+
+class SettingsStore:
+    """Read-through LRU cache with write-behind batching in front of a SettingsBackend"""
+
+    def __init__(self, backend, flush_interval=SETTINGS_FLUSH_INTERVAL,
+                 cache_size=SETTINGS_CACHE_SIZE, cache_ttl=SETTINGS_CACHE_TTL):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flush_task = None
+
+    async def get(self, user_id):
+        """Return a copy of the user's settings ({} when unset)"""
+        if user_id in self._dirty:
+            return dict(self._dirty[user_id])
+        item = self._cache.get(user_id)
+        if item is not None and time.monotonic() - item[1] < self.cache_ttl:
+            self._cache.move_to_end(user_id)
+            return dict(item[0])
+        try:
+            settings = await self.backend.load(user_id) or {}
+        except Exception as e:
+            logger.warning(f"⚠️ Settings read failed for {user_id}: {e}")
+            settings = item[0] if item else {}
+        self._remember(user_id, settings)
+        return dict(settings)
+
+    async def update(self, user_id, **values):
+        """Change some settings; the write reaches the backend on the next flush"""
+        settings = await self.get(user_id)
+        settings.update(values)
+        self._dirty[user_id] = settings
+        self._remember(user_id, settings)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _remember(self, user_id, settings):
+        self._cache[user_id] = (settings, time.monotonic())
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Write all pending changes in one batch"""
+        if not self._dirty:
+            return
+        pending, self._dirty = self._dirty, {}
+        try:
+            await self.backend.save_many(pending)
+        except Exception as e:
+            logger.error(f"❌ Settings flush failed, will retry: {e}")
+            # Keep newer changes made while the write was in flight
+            self._dirty = {**pending, **self._dirty}
+            if self._flush_task is None or self._flush_task.done() or self._flush_task is asyncio.current_task():
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def count(self):
+        try:
+            return await self.backend.count()
+        except Exception as e:
+            logger.warning(f"⚠️ Settings count failed: {e}")
+            return len(self._cache)
+
+    async def close(self):
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+        await self.flush()
+        await self.backend.close()
+
+def create_settings_backend():
+    """Pick the settings backend from SETTINGS_BACKEND"""
+    if SETTINGS_BACKEND == "redis":
+        if aioredis is not None:
+            logger.info("✅ Using Redis settings store")
+            return RedisSettingsBackend(REDIS_URL)
+        logger.warning("⚠️ SETTINGS_BACKEND=redis but the redis package is not installed, using SQLite")
+    if SETTINGS_BACKEND == "memory":
+        return MemorySettingsBackend()
+    return SQLiteSettingsBackend(SETTINGS_DB_PATH)
+
+# Store user language preferences
+settings_store = SettingsStore(create_settings_backend())
+
+async def get_user_lang(user_id):
+    """Return (language name, flag) for the user's target language"""
+    settings = await settings_store.get(user_id)
+    return LANG_CODES.get(settings.get("lang", DEFAULT_LANG), LANG_CODES[DEFAULT_LANG])
+
+async def get_user_targets(user_id):
+    """Return [(language name, flag), ...]: the /multi targets, or just the single target language"""
+    settings = await settings_store.get(user_id)
+    targets = [LANG_CODES[code] for code in settings.get("multi") or [] if code in LANG_CODES]
+    if len(targets) > 1:
+        return targets
+    return [LANG_CODES.get(settings.get("lang", DEFAULT_LANG), LANG_CODES[DEFAULT_LANG])]
+
+# --- Async HTTP Server for Health Checks and Webhooks ---
+start_time = time.time()
+# Set once the bot is connected to Telegram and processing updates
+bot_ready = asyncio.Event()
+
+async def home(request):
+    """Home page for health checks"""
+    return JSONResponse({
+        "status": "online",
+        "service": "Telegram AI Translator Bot",
+        "mode": "webhook" if WEBHOOK_URL else "polling",
+        "languages": len(LANG_CODES),
+        "groq_clients": groq_provider.key_count,
+        "sealion_clients": sealion_provider.key_count,
+        "uptime": round(time.time() - start_time, 2),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime())
+    })
+
+async def health(request):
+    """Health check endpoint for Render: 503 until the bot is ready to process updates"""
+    if not bot_ready.is_set():
+        return JSONResponse({"status": "starting"}, status_code=503)
+    return JSONResponse({"status": "healthy"}, status_code=200)
+
+async def status(request):
+    """Detailed status"""
+    return JSONResponse({
+        "telegram_bot": "running",
+        "groq_clients": groq_provider.key_count,
+        "sealion_clients": sealion_provider.key_count,
+        "users": await settings_store.count(),
+        "supported_languages": len(LANG_CODES),
+        "groq_keys_available": len(GROQ_KEYS),
+        "sealion_keys_available": len(SEA_KEYS),
+        "cache": translation_cache.stats(),
+        "translation_memory": translation_memory.stats() if translation_memory else None,
+        "keys": groq_provider.pool.snapshot() + sealion_provider.pool.snapshot(),
+        "scheduler": request_scheduler.snapshot(),
+        "routing": model_router.snapshot()
+    })
+
+async def metrics(request):
+    """Prometheus metrics"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def debug_denied(request):
+    """Error response unless the request carries DEBUG_TOKEN; the /debug routes don't exist without one"""
+    if not DEBUG_TOKEN:
+        return Response(status_code=404)
+    if DEBUG_TOKEN not in (request.headers.get("X-Debug-Token"), request.query_params.get("token")):
+        return Response(status_code=403)
+    return None
+
+async def debug_slow(request):
+    """Slowest traced requests with per-stage timings: ?handler=translate_ai to filter, ?reset=1 to clear"""
+    denied = debug_denied(request)
+    if denied is not None:
+        return denied
+    requests = slow_requests.snapshot(request.query_params.get("handler"))
+    if request.query_params.get("reset") == "1":
+        slow_requests.clear()
+    return JSONResponse({
+        "tracing": TRACE_ENABLED,
+        "recorded": slow_requests.recorded,
+        "keep": slow_requests.keep,
+        "requests": requests
+    })
+
+async def telegram_webhook(request):
+    """Receive Telegram updates and hand them to the bot's update queue"""
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return Response(status_code=400)
+    application = request.app.state.application
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return Response(status_code=200)
+
+def build_web_app(application):
+    """Build the HTTP app; the webhook route is only mounted in webhook mode"""
+    routes = [
+        Route("/", home),
+        Route("/health", health),
+        Route("/status", status),
+        Route("/metrics", metrics),
+        Route("/debug/slow", debug_slow),
+    ]
+    if WEBHOOK_URL:
+        routes.append(Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"]))
+    web_app = Starlette(routes=routes)
+    web_app.state.application = application
+    return web_app
+
+# --- Language pre-filter ---
+# Unicode blocks -> script; anything alphabetic outside these counts as "Other"
+SCRIPT_RANGES = sorted([
+    (0x0041, 0x005A, "Latin"), (0x0061, 0x007A, "Latin"), (0x00C0, 0x024F, "Latin"), (0x1E00, 0x1EFF, "Latin"),
+    (0x0370, 0x03FF, "Greek"), (0x1F00, 0x1FFF, "Greek"), (0x0400, 0x052F, "Cyrillic"),
+    (0x0530, 0x058F, "Armenian"), (0x0590, 0x05FF, "Hebrew"), (0x0600, 0x06FF, "Arabic"),
+    (0x0750, 0x077F, "Arabic"), (0xFB50, 0xFDFF, "Arabic"), (0xFE70, 0xFEFF, "Arabic"),
+    (0x0900, 0x097F, "Devanagari"), (0x0980, 0x09FF, "Bengali"), (0x0A00, 0x0A7F, "Gurmukhi"),
+    (0x0A80, 0x0AFF, "Gujarati"), (0x0B80, 0x0BFF, "Tamil"), (0x0C00, 0x0C7F, "Telugu"),
+    (0x0C80, 0x0CFF, "Kannada"), (0x0D00, 0x0D7F, "Malayalam"), (0x0D80, 0x0DFF, "Sinhala"),
+    (0x0E00, 0x0E7F, "Thai"), (0x0E80, 0x0EFF, "Lao"), (0x1000, 0x109F, "Myanmar"),
+    (0x10A0, 0x10FF, "Georgian"), (0x1100, 0x11FF, "Hangul"), (0x3130, 0x318F, "Hangul"),
+    (0xAC00, 0xD7AF, "Hangul"), (0x1200, 0x139F, "Ethiopic"), (0x1780, 0x17FF, "Khmer"),
+    (0x19E0, 0x19FF, "Khmer"), (0x3040, 0x30FF, "Kana"), (0x31F0, 0x31FF, "Kana"), (0xFF66, 0xFF9F, "Kana"),
+    (0x3400, 0x4DBF, "Han"), (0x4E00, 0x9FFF, "Han"), (0xF900, 0xFAFF, "Han"),
+])
+SCRIPT_RANGE_STARTS = [start for start, _, _ in SCRIPT_RANGES]
+
+# Scripts written by exactly one of the LANG_CODES languages
+SCRIPT_LANGUAGE = {
+    "Greek": "Greek", "Armenian": "Armenian", "Hebrew": "Hebrew", "Bengali": "Bengali", "Gurmukhi": "Punjabi",
+    "Gujarati": "Gujarati", "Tamil": "Tamil", "Telugu": "Telugu", "Kannada": "Kannada", "Malayalam": "Malayalam",
+    "Sinhala": "Sinhala", "Thai": "Thai", "Lao": "Lao", "Myanmar": "Burmese", "Georgian": "Georgian",
+    "Hangul": "Korean", "Ethiopic": "Amharic", "Khmer": "Khmer",
+}
+
+# Shared scripts: per-language profiles of frequent short words and distinctive letters
+LANGUAGE_PROFILES = {
+    "Latin": {
+        "English": ("the and is are you to of in it that this what was with for have not be do my we your they", ""),
+        "French": ("le la les et est un une des du que qui pas je vous nous il elle ce pour dans avec mais sont oui", "çèêàùœâîôûëï"),
+        "German": ("der die das und ist nicht ich du sie es ein eine zu mit auf den dem wir ihr sind was wie auch noch", "äöüß"),
+        "Spanish": ("el la los las y es de que en un una por para con no se lo su pero muy está estoy qué cómo yo", "ñ¿¡áíóú"),
+        "Italian": ("il lo la gli le e è di che non un una per con sono mi ti ci io tu lui lei questo come perché ma", "àèìòù"),
+        "Portuguese": ("o a os as e é de que não um uma do da em para com se eu você ele ela mas muito está são", "ãõçâêô"),
+        "Dutch": ("de het een en is van ik je dat niet die wat op te zijn we er maar met voor hij zij", ""),
+        "Polish": ("i w na nie to się jest że z do co jak ale tak ja ty on ona my są", "ąęłńśźżć"),
+        "Swedish": ("och är det att jag du inte en ett som på med för har vi de han hon vad", "åäö"),
+        "Danish": ("og er det at jeg du ikke en et som på med for har vi de han hun hvad til meget", "æøå"),
+        "Norwegian": ("og er det at jeg du ikke en et som på med for har vi de han hun hva til mye", "æøå"),
+        "Finnish": ("ja on ei se että minä sinä hän me te he mitä kun niin mutta tämä olen oli", "äö"),
+        "Czech": ("a je to že se na v ne jsem jsi co jak ale tak já ty on ona my být", "ěřůčšžý"),
+        "Slovak": ("a je to že sa na v nie som si čo ako ale tak ja ty on ona my byť", "äľĺŕôčšžý"),
+        "Romanian": ("și este în nu de la cu un o ce sunt eu tu el ea pe mai dar că", "ăâîșțşţ"),
+        "Hungarian": ("a az és hogy nem egy van is ez azt de meg én te ő mi ki mit", "őűáéíóöúü"),
+        "Croatian": ("i je u da se na ne su sam to što kako ali ja ti on ona mi smo", "čćđšž"),
+        "Serbian": ("i je u da se na ne su sam to šta kako ali ja ti on ona mi smo", "čćđšž"),
+        "Bosnian": ("i je u da se na ne su sam to šta kako ali ja ti on ona mi smo", "čćđšž"),
+        "Slovenian": ("in je v da se na ne so sem to kaj kako ampak jaz ti on ona mi smo", "čšž"),
+        "Estonian": ("ja on ei see et mina sina tema me te nad mis kui aga olen oli", "õäöü"),
+        "Latvian": ("un ir ne es tu viņš viņa mēs jūs tas kas bet ka par", "āčēģīķļņšūž"),
+        "Lithuanian": ("ir yra ne aš tu jis ji mes jūs tai kas bet kad su", "ąčęėįšųūž"),
+        "Turkish": ("ve bir bu da de ne için ben sen o biz siz değil var çok ama gibi", "çğıöşü"),
+        "Azerbaijani": ("və bir bu da də nə üçün mən sən o biz siz deyil var çox amma kimi", "əğıöşüç"),
+        "Uzbek": ("va bir bu men sen u biz siz emas bor juda lekin uchun nima", "ʻ"),
+        "Turkmen": ("we bir bu men sen ol biz siz däl bar örän emma üçin näme", "äňöüýžşç"),
+        "Vietnamese": ("và là của có không tôi bạn một những được người này cho với anh em các đã", "đơưăạảấầẩẫậắằẳẵặẹẻẽếềểễệỉịọỏốồổỗộớờởỡợụủứừửữựỳỵỷỹ"),
+        "Indonesian": ("yang dan di ini itu tidak saya anda kamu dengan untuk ada akan dari ke apa juga sudah bisa karena mau", ""),
+        "Malay": ("yang dan di ini itu tidak saya anda awak dengan untuk ada akan dari ke apa juga sudah boleh kerana mahu", ""),
+        "Filipino": ("ang ng mga sa na at ay ako ikaw siya kami tayo hindi ito iyan po ba ko mo", ""),
+        "Afrikaans": ("die en is nie ek jy het van in dit wat op vir met ons hulle", "ê"),
+        "Albanian": ("dhe është në të një për që nuk unë ti ai ajo ne ju me si", "ëç"),
+        "Basque": ("eta da ez bat hau hori ni zu gu zer nola baina dut duzu naiz", ""),
+        "Catalan": ("el la els les i és de que en un una per amb no es jo tu ell ella però molt", "àèéíïòóúç"),
+        "Galician": ("o a os as e é de que en un unha por para con non se eu ti el ela pero moito", ""),
+        "Icelandic": ("og er að það ég þú ekki en sem á með fyrir hann hún við", "þðæ"),
+        "Swahili": ("na ni ya wa kwa la za katika hii huo mimi wewe yeye sisi hapana ndiyo", ""),
+    },
+    "Cyrillic": {
+        "Russian": ("и в не на я что он с это как а по но она ты мы вы они есть был", "ыэё"),
+        "Ukrainian": ("і в не на я що він з це як а по але вона ти ми ви вони є був", "іїєґ"),
+        "Bulgarian": ("и в не на аз че той с това как а по но тя ти ние вие те е са", ""),
+        "Serbian": ("и у не на ја да он са то како а по али она ти ми ви они је су", "ђјљњћџ"),
+        "Belarusian": ("і ў не на я што ён з гэта як а па але яна ты мы вы яны ёсць", "ўі"),
+        "Kazakh": ("және бұл мен сен ол біз сіз емес бар өте бірақ үшін не", "әғқңөұүһі"),
+        "Kyrgyz": ("жана бул мен сен ал биз сиз эмес бар абдан бирок үчүн эмне", "ңөү"),
+        "Tajik": ("ва ин ман ту вай мо шумо нест ҳаст хеле аммо барои чӣ", "ғӣқӯҳҷ"),
+        "Mongolian": ("ба энэ би чи тэр бид та биш байна их гэхдээ юу", "өү"),
+    },
+    "Arabic": {
+        "Arabic": ("في من على أن إلى هذا هو هي لا ما كان", "ةى"),
+        "Persian": ("و در به از که این را با است من تو او ما شما نه", "پچژگیک"),
+    },
+    "Devanagari": {
+        "Hindi": ("है हैं का की के में नहीं और यह वह मैं आप हम क्या", ""),
+        "Nepali": ("छ छन् हो मा र यो त्यो म तपाईं हामी गर्न भएको", ""),
+    },
+}
+LANGUAGE_PROFILES = {
+    script: {language: (frozenset(words.split()), frozenset(letters)) for language, (words, letters) in profiles.items()}
+    for script, profiles in LANGUAGE_PROFILES.items()
+}
+
+PREFILTER_STRIP_RE = re.compile(r'https?://\S+|www\.\S+|\S+@\S+\.\w+|[@#]\w+')
+PREFILTER_WORD_STRIP = ".,!?;:\"'()[]{}<>…«»“”‘’¿¡।॥،؟-–—*/\\"
+# Letters examined per text: enough to identify the script and language
+PREFILTER_SAMPLE = 600
+
+def script_of(ch):
+    code = ord(ch)
+    position = bisect.bisect_right(SCRIPT_RANGE_STARTS, code) - 1
+    if position >= 0 and code <= SCRIPT_RANGES[position][1]:
+        return SCRIPT_RANGES[position][2]
+    return "Other" if ch.isalpha() else None
+
+def detect_language(text):
+    """Best local guess of the language name of text, "" when it has no letters, None when unsure"""
+    text = PREFILTER_STRIP_RE.sub(" ", text)
+    counts = defaultdict(int)
+    letters = 0
+    for ch in text:
+        if ch.isdigit() or ch.isspace():
+            continue
+        script = script_of(ch)
+        if script is None:
+            continue
+        counts["Han" if script == "Kana" else script] += 1
+        if script == "Kana":
+            counts["Kana"] += 1
+        letters += 1
+        if letters >= PREFILTER_SAMPLE:
+            break
+    if not letters:
+        return ""
+
+    script, count = max(((s, c) for s, c in counts.items() if s != "Kana"), key=lambda item: item[1])
+    if count < 0.8 * letters:
+        return None  # mixed scripts
+    if script == "Han":
+        return "Japanese" if counts["Kana"] >= 0.05 * count else "Chinese"
+    if script in SCRIPT_LANGUAGE:
+        return SCRIPT_LANGUAGE[script]
+    profiles = LANGUAGE_PROFILES.get(script)
+    if not profiles:
+        return None
+
+    words = [word.strip(PREFILTER_WORD_STRIP) for word in text.casefold().split()[:PREFILTER_SAMPLE // 4]]
+    words = [word for word in words if word]
+    text_letters = set(text.casefold())
+    scores = {}
+    for language, (common_words, distinctive) in profiles.items():
+        scores[language] = sum(1 for word in words if word in common_words) + 0.5 * len(distinctive & text_letters)
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, second_score) = ranked[0], ranked[1]
+    # Only trust clear evidence: a few hits, a solid share of the words and a margin over the runner-up
+    if best_score >= max(2, 0.15 * len(words)) and best_score >= 1.5 * second_score:
+        return best
+    return None
+
+def translation_skip_reason(text, target_lang):
+    """Why text needs no upstream call for target_lang ("no_text" or "same_language"), else None"""
+    if not PREFILTER_ENABLED:
+        return None
+    language = detect_language(text)
+    if language == "":
+        reason = "no_text"
+    elif language == target_lang:
+        reason = "same_language"
+    else:
+        return None
+    PREFILTER_SKIPS.labels(reason).inc()
+    return reason
+
+# --- Translation helpers ---
+def build_messages(provider, text, target_lang, mode="text", hints=None):
+    """Build the chat messages for a provider (mode: text, multi, srt or srt_batch)
+
+    `hints` are (source, translation) pairs of similar, previously translated lines.
+    """
+    if mode == "srt_batch":
+        instruction = (
+            f"You are a professional SRT subtitle translator. Translate each numbered subtitle below to {target_lang} language. "
+            f"Each subtitle starts with a marker line like [[1]]. Copy every marker line unchanged, put its translation on the lines after it, "
+            f"keep the same number of subtitles and preserve line breaks and special markers. Output ONLY the markers and translations."
+        )
+    elif mode == "multi":
+        # target_lang is a comma-separated list of languages here
+        languages = "\n".join(f"[[{n}]] {lang}" for n, lang in enumerate(target_lang.split(", "), start=1))
+        instruction = (
+            f"You are a professional translator. Translate the user's text into each of these languages:\n{languages}\n"
+            f"For each language output its marker line (like [[1]]) alone on a line, then the translation on the lines after it. "
+            f"Output ONLY the markers and translations, in the same order, without explanations."
+        )
+    elif mode == "srt":
+        instruction = (
+            f"You are a professional SRT subtitle translator. Translate the following subtitle text to {target_lang} language. "
+            f"Preserve all formatting, line breaks, and special markers. Output ONLY the translated text without explanations."
+        )
+    else:
+        instruction = (
+            f"You are a professional translator. Translate the user's text to {target_lang} language. "
+            f"Provide ONLY the translated text without any explanations, notes, or additional text."
+        )
+    if hints:
+        references = "\n".join(
+            f"- {source.replace(chr(10), ' / ')} => {translation.replace(chr(10), ' / ')}"
+            for source, translation in hints
+        )
+        instruction += (
+            f"\n\nSimilar lines were translated before as follows. Keep names and terminology consistent "
+            f"with them, but do not output them:\n{references}"
+        )
+    if provider.system_role:
+        return [
+            {"role": "system", "content": instruction},
+            {"role": "user", "content": text}
+        ]
+    return [{"role": "user", "content": f"{instruction}\n\n{text}"}]
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 chars per token for Latin, ~1 per char for other scripts)"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def output_token_budget(text, cap=TEXT_MAX_OUTPUT_TOKENS):
+    """max_tokens for translating text, scaled from its input size"""
+    return min(cap, max(TEXT_MIN_OUTPUT_TOKENS, int(estimate_tokens(text) * TEXT_OUTPUT_RATIO)))
+
+# Split points from coarsest to finest; each piece keeps its trailing separator
+TEXT_SPLIT_PATTERNS = (
+    re.compile(r'\n[ \t]*\n\s*'),                            # paragraphs
+    re.compile(r'[.!?។៕።।。！？]+["\'”’»)\]]*\s*|\n\s*'),     # sentences and lines
+    re.compile(r'[,;:،、，；]\s*|\s+'),                        # clauses and words
+)
+
+def _split_after(text, pattern):
+    pieces, start = [], 0
+    for match in pattern.finditer(text):
+        if match.end() > start:
+            pieces.append(text[start:match.end()])
+            start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+def split_text(text, limit, measure=estimate_tokens, patterns=TEXT_SPLIT_PATTERNS):
+    """Split text into pieces of at most `limit` (by `measure`) at the coarsest boundary that fits.
+
+    Joining the pieces gives back the original text exactly.
+    """
+    if measure(text) <= limit:
+        return [text]
+    if not patterns:
+        # No boundary left: cut proportionally
+        pieces = []
+        while measure(text) > limit:
+            cut = max(1, len(text) * limit // measure(text))
+            pieces.append(text[:cut])
+            text = text[cut:]
+        return pieces + [text] if text else pieces
+
+    segments = []
+    for piece in _split_after(text, patterns[0]):
+        segments.extend(split_text(piece, limit, measure, patterns[1:]))
+
+    # Greedily pack consecutive segments back together up to the limit
+    chunks, current = [], ""
+    for segment in segments:
+        if current and measure(current + segment) > limit:
+            chunks.append(current)
+            current = ""
+        current += segment
+    if current:
+        chunks.append(current)
+    return chunks
+
+class ModelRouter:
+    """Orders providers per target language from rolling latency and error statistics"""
+
+    def __init__(self, window=ROUTER_WINDOW, min_samples=ROUTER_MIN_SAMPLES, explore=ROUTER_EXPLORE):
+        self.window = window
+        self.min_samples = min_samples
+        self.explore = explore
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+
+    def eligible(self, target_lang):
+        """Providers that can serve a language, in default preference order"""
+        if target_lang in SEA_LANGS:
+            return [sealion_provider, groq_provider]
+        return [groq_provider]
+
+    def record(self, provider, target_lang, latency, ok):
+        self._samples[(provider.name, target_lang)].append((latency, ok))
+
+    def latency_percentile(self, provider, target_lang, pct):
+        """Observed latency percentile of successful calls, or None without enough data"""
+        latencies = sorted(latency for latency, ok in self._samples[(provider.name, target_lang)] if ok)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100))]
+
+    def expected_latency(self, provider, target_lang):
+        """Median latency inflated by the error rate (retrying elsewhere costs another call)"""
+        samples = self._samples[(provider.name, target_lang)]
+        if len(samples) < self.min_samples:
+            return None
+        success_rate = sum(1 for _, ok in samples if ok) / len(samples)
+        median = self.latency_percentile(provider, target_lang, 50)
+        if median is None:
+            return float("inf")
+        return median / max(success_rate, 0.05)
+
+    def route(self, target_lang, explore=True):
+        """Providers to try for a language, best first, skipping ones without clients
+
+        With `explore` the runner-up occasionally leads; pass False to read the ranking for display.
+        """
+        providers = [provider for provider in self.eligible(target_lang) if provider.key_count]
+        if len(providers) < 2:
+            return providers
+        scores = [self.expected_latency(provider, target_lang) for provider in providers]
+        if None in scores:
+            ranked = providers  # not enough data yet, keep the default order
+        else:
+            ranked = [provider for _, _, provider in sorted(
+                (score, position, provider) for position, (score, provider) in enumerate(zip(scores, providers))
+            )]
+        if explore and random.random() < self.explore:
+            # Occasionally lead with the runner-up so its statistics stay current
+            ranked[0], ranked[1] = ranked[1], ranked[0]
+        return ranked
+
+    def hedge_delay(self, provider, target_lang):
+        """How long to wait on the primary before firing the secondary"""
+        p95 = self.latency_percentile(provider, target_lang, 95)
+        if p95 is None:
+            return ROUTER_HEDGE_DEFAULT_DELAY
+        return max(ROUTER_HEDGE_MIN_DELAY, p95)
+
+    def primary_name(self, target_lang):
+        providers = self.route(target_lang, explore=False) or self.eligible(target_lang)
+        return "Sea Lion" if providers[0] is sealion_provider else "Groq/Llama"
+
+    def snapshot(self):
+        stats = {}
+        for (name, target_lang), samples in self._samples.items():
+            latencies = sorted(latency for latency, ok in samples if ok)
+            stats.setdefault(target_lang, {})[name] = {
+                "samples": len(samples),
+                "error_rate": round(1 - len(latencies) / len(samples), 3) if samples else 0.0,
+                "p50_ms": round(latencies[len(latencies) // 2] * 1000) if latencies else None,
+                "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000) if latencies else None
+            }
+        return stats
+
+model_router = ModelRouter()
+
+def candidate_providers(target_lang):
+    """Providers to try for a language, in routing order, skipping ones without clients"""
+    return model_router.route(target_lang)
+
+async def call_provider(provider, text, target_lang, mode, max_tokens, max_wait, hints=None):
+    """One provider call, recording its latency and outcome for routing
+
+    Multi-target calls are not recorded: their target_lang is a list of languages, not a routing key.
+    """
+    record = mode != "multi"
+    started = time.perf_counter()
+    try:
+        # One span per provider attempt, so a fallback shows up as a failed span followed by another
+        with trace_span(f"llm:{provider.name}"):
+            result = await provider.complete(
+                build_messages(provider, text, target_lang, mode=mode, hints=hints),
+                max_tokens=max_tokens,
+                max_wait=max_wait
+            )
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        if record:
+            model_router.record(provider, target_lang, time.perf_counter() - started, False)
+        raise
+    if record:
+        model_router.record(provider, target_lang, time.perf_counter() - started, True)
+    return result
+
+async def request_translation(text, target_lang, mode="text", max_tokens=200, user_id=None, lane=LANE_INTERACTIVE,
+                              hints=None):
+    """Call the providers in order and return (translation, provider), without caching"""
+    key_wait = SRT_KEY_MAX_WAIT if lane == LANE_BULK else KEY_MAX_WAIT
+    async with request_scheduler.slot(user_id, lane, cost=estimate_tokens(text) + max_tokens):
+        return await _request_translation(text, target_lang, mode, max_tokens, hints, key_wait)
+
+async def _request_translation(text, target_lang, mode, max_tokens, hints=None, key_wait=KEY_MAX_WAIT):
+    providers = candidate_providers(target_lang)
+    if ROUTER_HEDGING and len(providers) > 1:
+        return await _hedged_translation(
+            providers[0], providers[1], text, target_lang, mode, max_tokens, hints, key_wait
+        )
+
+    last_error = None
+    for position, provider in enumerate(providers):
+        # Only the last provider waits for a rate-limited key; earlier ones fall through immediately
+        max_wait = key_wait if position == len(providers) - 1 else 0
+        try:
+            logger.info(f"Using {provider.name} for {target_lang}")
+            result = await call_provider(provider, text, target_lang, mode, max_tokens, max_wait, hints)
+            return result, provider
+        except Exception as e:
+            logger.warning(f"{provider.name} failed: {e}")
+            last_error = e
+
+    if last_error:
+        raise last_error
+    raise NoClientAvailable("No AI client available")
+
+async def _hedged_translation(primary, secondary, text, target_lang, mode, max_tokens, hints=None,
+                              key_wait=KEY_MAX_WAIT):
+    """Fire the secondary if the primary is slower than its p95; first success wins, the loser is cancelled"""
+    tasks = {
+        asyncio.ensure_future(call_provider(primary, text, target_lang, mode, max_tokens, 0, hints)): primary
+    }
+    last_error = None
+    pending = set(tasks)
+    try:
+        # Inside the try so a caller cancelled during the hedge delay cancels the primary too
+        done, _ = await asyncio.wait(pending, timeout=model_router.hedge_delay(primary, target_lang))
+        if not done or next(iter(done)).exception() is not None:
+            logger.info(f"Hedging {primary.name} with {secondary.name} for {target_lang}")
+            tasks[asyncio.ensure_future(
+                call_provider(secondary, text, target_lang, mode, max_tokens, key_wait, hints)
+            )] = secondary
+            pending = set(tasks)
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if len(tasks) > 1:
+                        HEDGED_REQUESTS.labels("primary" if tasks[task] is primary else "secondary").inc()
+                    return task.result(), tasks[task]
+                last_error = task.exception()
+                logger.warning(f"{tasks[task].name} failed: {last_error}")
+        raise last_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def cached_translations(texts, target_lang, mode="text"):
+    """Return cached translations for texts (None where missing), checking each candidate model"""
+    results = [None] * len(texts)
+    for provider in candidate_providers(target_lang):
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            break
+        keys = {i: translation_cache.make_key(texts[i], target_lang, provider.model, mode) for i in pending}
+        found = await translation_cache.get_many(list(set(keys.values())))
+        for i, key in keys.items():
+            results[i] = found.get(key)
+    return results
+
+async def store_translation(text, target_lang, provider, mode, result):
+    """Cache a translation under the model that produced it"""
+    await translation_cache.set(translation_cache.make_key(text, target_lang, provider.model, mode), result)
+
+class SingleFlight:
+    """Coalesce concurrent identical calls onto one in-flight task"""
+
+    def __init__(self):
+        self._calls = {}
+        self._waiters = defaultdict(int)
+
+    async def do(self, key, call):
+        """Await call() once per key; concurrent callers with the same key share its result or error
+
+        The call is cancelled once every caller waiting on it has been cancelled, so it does
+        not keep holding a scheduler slot and key budget for nobody.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            COALESCED_REQUESTS.inc()
+        self._waiters[task] += 1
+        try:
+            # Shield so one waiter being cancelled does not cancel the call for the others
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    # Last waiter left: later callers start a fresh call instead of joining this one
+                    if self._calls.get(key) is task:
+                        del self._calls[key]
+                    task.cancel()
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter went away
+
+    def __len__(self):
+        return len(self._calls)
+
+inflight_translations = SingleFlight()
+
+async def translate_text(text, target_lang, mode="text", max_tokens=None, user_id=None, lane=LANE_INTERACTIVE,
+                         hints=None):
+    """Translate text with the routed providers; max_tokens defaults to a budget scaled from the input"""
+    with trace_span("cache"):
+        (cached,) = await cached_translations([text], target_lang, mode)
+    if cached is not None:
+        return cached
+    if max_tokens is None:
+        max_tokens = output_token_budget(text)
+
+    async def translate_uncached():
+        result, provider = await request_translation(
+            text, target_lang, mode=mode, max_tokens=max_tokens, user_id=user_id, lane=lane, hints=hints
+        )
+        await store_translation(text, target_lang, provider, mode, result)
+        return result
+
+    route = "+".join(sorted(provider.model for provider in candidate_providers(target_lang)))
+    key = translation_cache.make_key(text, target_lang, route, f"{mode}:{max_tokens}:{hints!r}")
+    return await inflight_translations.do(key, translate_uncached)
+
+async def stream_translation(text, target_lang, max_tokens=None, user_id=None):
+    """Translate text as a stream of deltas, falling back to the next provider until output starts"""
+    (cached,) = await cached_translations([text], target_lang, "text")
+    if cached is not None:
+        yield cached
+        return
+    if max_tokens is None:
+        max_tokens = output_token_budget(text)
+
+    async with request_scheduler.slot(user_id, LANE_INTERACTIVE, cost=estimate_tokens(text) + max_tokens):
+        async for delta in _stream_translation(text, target_lang, max_tokens):
+            yield delta
+
+async def _stream_translation(text, target_lang, max_tokens):
+    last_error = None
+    providers = candidate_providers(target_lang)
+    for position, provider in enumerate(providers):
+        max_wait = KEY_MAX_WAIT if position == len(providers) - 1 else 0
+        parts = []
+        try:
+            logger.info(f"Streaming {provider.name} for {target_lang}")
+            # Includes the time the caller spends editing the reply between deltas
+            with trace_span(f"llm_stream:{provider.name}"):
+                async for delta in provider.stream(
+                    build_messages(provider, text, target_lang),
+                    max_tokens=max_tokens,
+                    max_wait=max_wait
+                ):
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            if parts:
+                raise  # already shown to the user, can't switch providers mid-reply
+            logger.warning(f"{provider.name} stream failed: {e}")
+            last_error = e
+            continue
+        await store_translation(text, target_lang, provider, "text", "".join(parts).strip())
+        return
+
+    if last_error:
+        raise last_error
+    raise NoClientAvailable("No AI client available")
+
+async def translate_long_text(text, target_lang, user_id=None, lane=LANE_INTERACTIVE):
+    """Translate text of any length: chunk on sentence boundaries, translate concurrently, reassemble in order"""
+    chunks = split_text(text, TEXT_CHUNK_TOKENS)
+    if len(chunks) == 1:
+        return await translate_text(text, target_lang, user_id=user_id, lane=lane)
+
+    async def translate_chunk(chunk):
+        core = chunk.strip()
+        if not core or translation_skip_reason(core, target_lang):
+            return chunk
+        # Keep the original paragraph/sentence spacing around each translated chunk
+        leading = chunk[:len(chunk) - len(chunk.lstrip())]
+        trailing = chunk[len(chunk.rstrip()):]
+        result = await translate_text(core, target_lang, user_id=user_id, lane=lane)
+        return leading + result.strip() + trailing
+
+    logger.info(f"Translating {len(chunks)} chunks to {target_lang}")
+    return "".join(await asyncio.gather(*(translate_chunk(chunk) for chunk in chunks))).strip()
+
+async def translate_multi(text, target_langs, user_id=None):
+    """Translate text into several languages, returning the results in target order
+
+    Short texts get one structured request covering every uncached language; long texts,
+    or a response that does not split back into the languages, fall back to concurrent
+    per-language translation.
+    """
+    results = {}
+    for target_lang in target_langs:
+        if translation_skip_reason(text, target_lang):
+            results[target_lang] = text
+            continue
+        (cached,) = await cached_translations([text], target_lang, "text")
+        if cached is not None:
+            results[target_lang] = cached
+    missing = [target_lang for target_lang in target_langs if target_lang not in results]
+
+    if len(missing) > 1 and estimate_tokens(text) * len(missing) <= TEXT_CHUNK_TOKENS:
+        try:
+            response_text, provider = await request_translation(
+                text, ", ".join(missing), mode="multi",
+                max_tokens=output_token_budget(text) * len(missing), user_id=user_id
+            )
+            for target_lang, result in zip(missing, parse_srt_batch_response(response_text, len(missing))):
+                results[target_lang] = result
+                # Cache per language so later single-language requests reuse it
+                await store_translation(text, target_lang, provider, "text", result)
+            missing = []
+        except Exception as e:
+            # Includes NoClientAvailable: the combined key routes like an unknown language, while
+            # each target on its own may still have a provider
+            logger.warning(f"Combined translation failed, translating each language: {e}")
+
+    translated = await asyncio.gather(*(
+        translate_long_text(text, target_lang, user_id=user_id) for target_lang in missing
+    ))
+    results.update(zip(missing, translated))
+    return [results[target_lang] for target_lang in target_langs]
+
+async def close_resources(application):
+    """Close provider HTTP pools and flush stores when the bot shuts down"""
+    await groq_provider.aclose()
+    await sealion_provider.aclose()
+    translation_cache.close()
+    if translation_memory:
+        translation_memory.close()
+    await settings_store.close()
+
+# --- SRT Translation Functions (NEW) ---
+class SubtitleCue(NamedTuple):
+    """One SRT cue"""
+    index: str
+    timestamp: str
+    text: str
+
+SRT_TIMESTAMP_RE = re.compile(r'^\d[\d:,.]*\s*-->\s*\d[\d:,.]*')
+
+def detect_srt_encoding(data):
+    """Guess the encoding of an uploaded SRT file from its BOM, falling back from UTF-8 to cp1252"""
+    if data.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if data.startswith(codecs.BOM_UTF16_LE) or data.startswith(codecs.BOM_UTF16_BE):
+        return "utf-16"
+    try:
+        data.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252"
+
+def decode_srt_bytes(data):
+    """Decode SRT bytes to text with universal newlines"""
+    encoding = detect_srt_encoding(data)
+    with io.TextIOWrapper(io.BytesIO(data), encoding=encoding, errors="replace", newline=None) as stream:
+        return stream.read()
+
+def iter_srt_cues(source):
+    """Parse SRT bytes or text incrementally, yielding SubtitleCue records
+
+    Tolerates CRLF/CR line endings, BOMs, missing or extra blank lines and cues without an index line.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        stream = io.TextIOWrapper(io.BytesIO(source), encoding=detect_srt_encoding(source), errors="replace", newline=None)
+    else:
+        stream = io.StringIO(source.lstrip("\ufeff"), newline=None)
+
+    index = None
+    timestamp = None
+    text_lines = []
+    with stream:
+        for raw_line in stream:
+            line = raw_line.strip().lstrip("\ufeff")
+            if timestamp is None:
+                if not line:
+                    continue
+                if SRT_TIMESTAMP_RE.match(line):
+                    timestamp = line
+                elif line.isdigit():
+                    index = line
+                else:
+                    logger.warning(f"Skipping unexpected SRT line: {line[:50]}")
+                continue
+            if SRT_TIMESTAMP_RE.match(line):
+                # Next cue started without a blank line; a bare number just before it is its index
+                next_index = text_lines.pop() if text_lines and text_lines[-1].isdigit() else None
+                if text_lines:
+                    yield SubtitleCue(index or "", timestamp, "\n".join(text_lines))
+                index, timestamp, text_lines = next_index, line, []
+                continue
+            if line:
+                text_lines.append(line)
+                continue
+            # A blank line ends the cue once it has text
+            if text_lines:
+                yield SubtitleCue(index or "", timestamp, "\n".join(text_lines))
+                index, timestamp, text_lines = None, None, []
+
+    if timestamp is not None and text_lines:
+        yield SubtitleCue(index or "", timestamp, "\n".join(text_lines))
+
+def parse_srt_content(srt_text):
+    """Parse SRT content into a list of subtitle cues"""
+    return list(iter_srt_cues(srt_text))
+
+def srt_output_name(original_name, target_lang):
+    """File name for a translation; LANG_CODES keys are unique where name prefixes are not (Swedish/Swahili)"""
+    return f"{original_name}_{LANG_NAME_CODES.get(target_lang, target_lang.lower())}.srt"
 
-# ទាញយក GROQ API Keys (អាចមានច្រើន)
-GROQ_KEYS_STR = os.environ.get("GROQ_API_KEYS", "")
-if GROQ_KEYS_STR:
-    GROQ_KEYS = [key.strip() for key in GROQ_KEYS_STR.split(",") if key.strip()]
-else:
-    GROQ_KEYS = []
+def serialize_srt(cues):
+    """Serialize cues to UTF-8 SRT bytes, renumbering cues that had no index"""
+    return "".join(
+        f"{cue.index or position}\n{cue.timestamp}\n{cue.text}\n\n"
+        for position, cue in enumerate(cues, start=1)
+    ).encode("utf-8")
 
-# ទាញយក Sea Lion API Keys (អាចមានច្រើន)
-SEA_KEYS_STR = os.environ.get("SEA_LION_API_KEYS", "")
-if SEA_KEYS_STR:
-    SEA_KEYS = [key.strip() for key in SEA_KEYS_STR.split(",") if key.strip()]
-else:
-    SEA_KEYS = []
+async def translate_srt_text(text_to_translate, target_lang, user_id=None, hint=None):
+    """Translate SRT text using appropriate AI client, retrying failed cues; None if it stays untranslated"""
+    for attempt in range(SRT_CUE_RETRIES + 1):
+        try:
+            return await translate_text(
+                text_to_translate, target_lang, mode="srt", max_tokens=300, user_id=user_id, lane=LANE_BULK,
+                hints=[hint] if hint else None
+            )
+        except NoClientAvailable:
+            return None
+        except Exception as e:
+            if attempt < SRT_CUE_RETRIES:
+                logger.warning(f"SRT cue failed (attempt {attempt + 1}), retrying: {e}")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+            else:
+                logger.error(f"SRT Translation error: {e}")
+    return None
 
-# ត្រួតពិនិត្យ Token
-if not TOKEN:
-    logger.error("❌ ERROR: TELEGRAM_TOKEN not found!")
-    logger.info("💡 Please add TELEGRAM_TOKEN to Render Environment Variables")
-    exit(1)
+SRT_MARKER_RE = re.compile(r'^\s*\[\[(\d+)\]\]\s*$', re.MULTILINE)
 
-# Initialize AI Clients with multiple keys
-client_groq_list = []
-client_sealion_list = []
+class SRTBatchMismatch(Exception):
+    """Raised when a batched SRT response does not map back onto its cues"""
 
-# Create multiple Groq clients
-for i, api_key in enumerate(GROQ_KEYS):
-    try:
-        client = Groq(api_key=api_key)
-        client_groq_list.append(client)
-        logger.info(f"✅ Groq client {i+1} initialized")
-    except Exception as e:
-        logger.warning(f"⚠️ Failed to initialize Groq client {i+1}: {e}")
+def make_srt_batches(texts, token_budget=SRT_BATCH_TOKENS, max_cues=SRT_BATCH_MAX_CUES):
+    """Group consecutive cue indexes into batches that fit the token budget"""
+    batches = []
+    current = []
+    current_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text) + 4  # marker overhead
+        if current and (current_tokens + tokens > token_budget or len(current) >= max_cues):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def parse_srt_batch_response(response_text, expected):
+    """Split a batched response on its [[N]] markers into `expected` cue texts"""
+    parts = SRT_MARKER_RE.split(response_text)
+    # parts = [preamble, "1", text1, "2", text2, ...]
+    numbers = [int(n) for n in parts[1::2]]
+    if numbers != list(range(1, expected + 1)):
+        raise SRTBatchMismatch(f"expected markers 1..{expected}, got {len(numbers)} markers")
+    texts = [text.strip() for text in parts[2::2]]
+    if any(not text for text in texts):
+        raise SRTBatchMismatch("empty translation for a marker")
+    return texts
 
-# Create multiple Sea Lion clients
-for i, api_key in enumerate(SEA_KEYS):
+async def translate_srt_batch(texts, target_lang, user_id=None, hints=None):
+    """Translate several cues in one request using numbered markers"""
+    payload = "\n".join(f"[[{n}]]\n{text}" for n, text in enumerate(texts, start=1))
+    max_tokens = output_token_budget(payload, cap=SRT_BATCH_MAX_OUTPUT_TOKENS)
+    response_text, provider = await request_translation(
+        payload, target_lang, mode="srt_batch", max_tokens=max_tokens, user_id=user_id, lane=LANE_BULK,
+        hints=hints
+    )
+    translated = parse_srt_batch_response(response_text, len(texts))
+    # Cache per cue so batched and single-cue requests share entries
+    await translation_cache.set_many({
+        translation_cache.make_key(text, target_lang, provider.model, "srt"): result
+        for text, result in zip(texts, translated)
+    })
+    return translated
+
+async def translate_srt_group(texts, target_lang, user_id=None, hints=None):
+    """Translate a group of cues, splitting the batch and retrying smaller pieces on failure
+
+    `hints` maps cue text to a (source, translation) reference from the translation memory.
+    Cues that could not be translated come back as None.
+    """
+    hints = hints or {}
+    if len(texts) == 1:
+        return [await translate_srt_text(texts[0], target_lang, user_id, hints.get(texts[0]))]
     try:
-        client = OpenAI(
-            base_url="https://api-inference.huggingface.co/v1/", 
-            api_key=api_key
+        return await translate_srt_batch(
+            texts, target_lang, user_id, [hints[text] for text in texts if text in hints] or None
         )
-        client_sealion_list.append(client)
-        logger.info(f"✅ Sea Lion client {i+1} initialized")
+    except NoClientAvailable:
+        return [None] * len(texts)
     except Exception as e:
-        logger.warning(f"⚠️ Failed to initialize Sea Lion client {i+1}: {e}")
+        logger.warning(f"SRT batch of {len(texts)} failed, splitting: {e}")
+    middle = len(texts) // 2
+    left = await translate_srt_group(texts[:middle], target_lang, user_id, hints)
+    right = await translate_srt_group(texts[middle:], target_lang, user_id, hints)
+    return left + right
 
-# Store user language preferences
-user_settings = {}
+def same_words(a, b):
+    """Whether two cues have the same words and numbers, so a reused translation cannot change the meaning"""
+    return (re.findall(r'\w+', TranslationMemory.normalize(a))
+            == re.findall(r'\w+', TranslationMemory.normalize(b)))
 
-# --- Flask HTTP Server for Health Checks ---
-app = Flask(__name__)
-start_time = time.time()
+SENTENCE_END_RE = re.compile(r'([?!.…？！。]*)[^\w?!.…？！。]*$')
 
-@app.route('/')
-def home():
-    """Home page for health checks"""
-    return jsonify({
-        "status": "online",
-        "service": "Telegram AI Translator Bot",
-        "languages": len(LANG_CODES),
-        "groq_clients": len(client_groq_list),
-        "sealion_clients": len(client_sealion_list),
-        "uptime": round(time.time() - start_time, 2),
-        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime())
-    })
+def sentence_ending(text):
+    """Final sentence marks of a cue ("?", "!", "…"); a full stop counts the same as none"""
+    marks = SENTENCE_END_RE.search(text).group(1).replace("...", "…").replace("？", "?").replace("！", "!")
+    return "" if marks in (".", "。") else marks
 
-@app.route('/health')
-def health():
-    """Health check endpoint for Render"""
-    return jsonify({"status": "healthy"}), 200
+def same_ending(a, b):
+    """Whether two cues end the same way, so a statement's translation is never reused for a question"""
+    return sentence_ending(a) == sentence_ending(b)
 
-@app.route('/status')
-def status():
-    """Detailed status"""
-    return jsonify({
-        "telegram_bot": "running",
-        "groq_clients": len(client_groq_list),
-        "sealion_clients": len(client_sealion_list),
-        "users": len(user_settings),
-        "supported_languages": len(LANG_CODES),
-        "groq_keys_available": len(GROQ_KEYS),
-        "sealion_keys_available": len(SEA_KEYS)
-    })
+def srt_concurrency():
+    """Number of cue requests allowed in flight, scaled by the number of API keys"""
+    keys = groq_provider.key_count + sealion_provider.key_count
+    return max(1, min(SRT_MAX_CONCURRENCY, SRT_CONCURRENCY_PER_KEY * max(keys, 1)))
 
-def run_flask_server():
-    """Run Flask server in a separate thread"""
-    port = int(os.environ.get("PORT", 10000))
-    logger.info(f"🌐 Starting Flask server on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+async def translate_srt_entries(entries, target_lang, on_progress=None, completed=None, on_checkpoint=None, user_id=None,
+                                untranslated=None):
+    """Translate SRT entries concurrently (batched when enabled), returning them in the original order
 
-# --- Helper functions for API key rotation ---
-def get_groq_client():
-    """Get a Groq client using round-robin selection"""
-    if not client_groq_list:
-        return None
-    # Simple round-robin selection
-    current_index = getattr(get_groq_client, 'index', 0)
-    client = client_groq_list[current_index % len(client_groq_list)]
-    get_groq_client.index = (current_index + 1) % len(client_groq_list)
-    return client
-
-def get_sealion_client():
-    """Get a Sea Lion client using round-robin selection"""
-    if not client_sealion_list:
-        return None
-    # Simple round-robin selection
-    current_index = getattr(get_sealion_client, 'index', 0)
-    client = client_sealion_list[current_index % len(client_sealion_list)]
-    get_sealion_client.index = (current_index + 1) % len(client_sealion_list)
-    return client
+    `completed` maps entry positions to already translated text (from a checkpoint) and
+    `on_checkpoint` receives [(position, text), ...] after every translated batch. Cues that
+    failed after all retries keep their source text, are not checkpointed (a resumed job tries
+    them again) and have their positions added to the `untranslated` set when one is given.
+    """
+    texts = [entry.text for entry in entries]
+    results = [None] * len(entries)
+    completed = completed or {}
 
-# --- SRT Translation Functions (NEW) ---
-def parse_srt_content(srt_text):
-    """Parse SRT content into list of subtitle entries"""
-    entries = []
-    blocks = srt_text.strip().split('\n\n')
-    
-    for block in blocks:
-        lines = block.strip().split('\n')
-        if len(lines) >= 3:
+    def fill(i, translated_text):
+        results[i] = entries[i]._replace(text=translated_text)
+
+    # Serve previously seen cues from the cache and translate repeated lines only once
+    cached = await cached_translations(texts, target_lang, "srt")
+    unique = {}
+    for i, translated_text in enumerate(cached):
+        if i in completed:
+            fill(i, completed[i])
+        elif translated_text is not None:
+            fill(i, translated_text)
+        elif translation_skip_reason(texts[i], target_lang):
+            # Sound symbols, numbers and lines already in the target language stay as they are
+            fill(i, texts[i])
+        else:
+            unique.setdefault(texts[i], []).append(i)
+
+    # Reuse the translation memory for recurring and near-identical lines from earlier files
+    hints = {}
+    if translation_memory and unique:
+        matches = await translation_memory.lookup_many(list(unique), target_lang)
+        for text in list(unique):
+            match = matches.get(text)
+            if match and same_words(text, match.source) and same_ending(text, match.source):
+                for i in unique.pop(text):
+                    fill(i, match.translation)
+                translation_memory.record("exact" if match.similarity == 1.0 else "fuzzy")
+            elif match and match.similarity >= (TM_HINT_THRESHOLD if TM_HINTS else TM_THRESHOLD):
+                # A near match may differ in one word ("can" / "can't"), so the model gets it as a reference only
+                hints[text] = (match.source, match.translation)
+                translation_memory.record("hint")
+            else:
+                translation_memory.record("miss")
+
+    unique_texts = list(unique)
+    done = len(entries) - sum(len(indexes) for indexes in unique.values())
+    SRT_CUES_PROCESSED.inc(done - len(completed))
+
+    if SRT_BATCHING:
+        batches = make_srt_batches(unique_texts)
+    else:
+        batches = [[j] for j in range(len(unique_texts))]
+
+    semaphore = asyncio.Semaphore(srt_concurrency())
+
+    async def translate_batch(batch):
+        nonlocal done
+        sources = [unique_texts[j] for j in batch]
+        async with semaphore:
+            translated = await translate_srt_group(sources, target_lang, user_id, hints)
+        if translation_memory:
+            await translation_memory.add_many(
+                [(source, text) for source, text in zip(sources, translated) if text is not None], target_lang
+            )
+        previous = done
+        checkpoint = []
+        for j, translated_text in zip(batch, translated):
+            for i in unique[unique_texts[j]]:
+                done += 1
+                if translated_text is None:
+                    fill(i, texts[i])
+                    if untranslated is not None:
+                        untranslated.add(i)
+                    continue
+                fill(i, translated_text)
+                checkpoint.append((i, translated_text))
+        SRT_CUES_PROCESSED.inc(len(checkpoint))
+        if on_checkpoint:
+            await on_checkpoint(checkpoint)
+        if on_progress:
+            await on_progress(previous, done, len(entries))
+
+    await asyncio.gather(*(translate_batch(batch) for batch in batches))
+    return results
+
+# --- Outbound Telegram flood control ---
+class TelegramRateLimiter(BaseRateLimiter):
+    """Throttles Bot API calls with a global and a per-chat token bucket and retries after RetryAfter
+
+    Calls with a chat_id wait until both buckets have a token; private chats and groups get their
+    own rates. A RetryAfter pauses only the chat it came from (or every call, if it had no chat)
+    for the time Telegram asked for, then the call is retried up to `max_retries` times.
+    """
+
+    # Chat buckets kept; the least recently used one is dropped beyond this
+    MAX_CHATS = 10000
+    # Chat actions ("typing") are best effort and not worth a token
+    UNTHROTTLED = frozenset(["sendChatAction"])
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 group_rate=TELEGRAM_GROUP_RATE, chat_burst=TELEGRAM_CHAT_BURST, max_retries=TELEGRAM_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate * 60, burst=max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = OrderedDict()  # chat id -> [TokenBucket, paused until, Lock]
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat(self, chat_id):
+        state = self._chats.get(chat_id)
+        if state is None:
+            # Negative ids and @usernames are groups and channels
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate, burst=self.chat_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate * 60, burst=self.chat_burst)
+            # The lock makes a chat's calls take tokens in arrival order
+            state = self._chats[chat_id] = [bucket, 0.0, asyncio.Lock()]
+            if len(self._chats) > self.MAX_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return state
+
+    def _wait_time(self, chat, now):
+        wait = self._paused_until - now
+        if chat is not None:
+            wait = max(wait, chat[1] - now, self.global_bucket.wait_time(1, now), chat[0].wait_time(1, now))
+        return wait
+
+    async def _acquire(self, chat, endpoint):
+        """Wait for a token in the global and chat buckets (or for a RetryAfter pause to end)"""
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            wait = self._wait_time(chat, now)
+            if wait <= 0:
+                break
+            await asyncio.sleep(min(wait, 1.0))
+        if chat is not None:
+            self.global_bucket.consume(1, now)
+            chat[0].consume(1, now)
+        waited = now - started
+        if waited > 0:
+            TELEGRAM_THROTTLED.labels(endpoint).observe(waited)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add_span("flood_wait", time.perf_counter() - waited, waited)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if endpoint in self.UNTHROTTLED or chat_id is None:
+            chat = None
+        else:
             try:
-                index = lines[0].strip()
-                timestamp = lines[1].strip()
-                text_lines = lines[2:]
-                # Combine multiple text lines
-                text = '\n'.join(text_lines)
-                
-                entries.append({
-                    'index': index,
-                    'timestamp': timestamp,
-                    'text': text,
-                    'original_block': block
-                })
+                chat_id = int(chat_id)
+            except ValueError:
+                pass  # @channelusername
+            chat = self._chat(chat_id)
+
+        attempt = 0
+        while True:
+            if chat is None:
+                await self._acquire(chat, endpoint)
+            else:
+                async with chat[2]:
+                    await self._acquire(chat, endpoint)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                TELEGRAM_RETRY_AFTER.labels(endpoint).inc()
+                paused_until = time.monotonic() + float(e.retry_after) + 0.1
+                if chat is not None:
+                    chat[1] = max(chat[1], paused_until)
+                else:
+                    self._paused_until = max(self._paused_until, paused_until)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning(f"🚦 {endpoint} to {chat_id} flood limited, retrying in {e.retry_after}s")
+
+class ProgressReporter:
+    """Keeps a progress message up to date with at most one edit per `interval`
+
+    update() only records the newest text. One background task sends it once the interval has
+    passed since the previous edit, so states superseded in the meantime never cost an API call.
+    """
+
+    def __init__(self, edit, interval=PROGRESS_EDIT_INTERVAL, shown=None):
+        self._edit = edit  # async callable taking the new text
+        self.interval = interval
+        self._latest = None
+        # Text the message already shows, e.g. when it was just sent
+        self._shown = shown
+        self._last_edit = time.monotonic() if shown is not None else 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = False
+        self._closing = False
+
+    def update(self, text):
+        if self._closing:
+            return
+        self._latest = text
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            delay = self._last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._sending = True
+            try:
+                await self._send()
             except Exception as e:
-                logger.warning(f"Failed to parse SRT block: {e}")
-                continue
-    
-    return entries
+                logger.debug(f"Progress update skipped: {e}")
+            finally:
+                self._sending = False
 
-def translate_srt_text(text_to_translate, target_lang):
-    """Translate SRT text using appropriate AI client"""
-    # Southeast Asian languages that Sea Lion handles well
-    sea_langs = ["Khmer", "Thai", "Vietnamese", "Lao", "Indonesian", "Malay", "Burmese", "Filipino"]
-    
-    try:
-        if target_lang in sea_langs:
-            # Try Sea Lion first
-            client = get_sealion_client()
-            if client:
+    async def _send(self):
+        text = self._latest
+        if text is None or text == self._shown:
+            PROGRESS_EDITS.labels("skipped").inc()
+            return
+        self._last_edit = time.monotonic()
+        await self._edit(text)
+        self._shown = text
+        PROGRESS_EDITS.labels("sent").inc()
+
+    async def close(self, final=None):
+        """Stop the background task; with `final`, show that text now (errors are raised)"""
+        self._closing = True
+        if self._task is not None:
+            if not self._sending:
+                self._task.cancel()  # idle or waiting out the interval
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if final is not None:
+            self._latest = final
+            await self._send()
+
+# --- SRT job queue ---
+class SRTJobStore:
+    """SQLite storage for SRT jobs and their per-cue checkpoints"""
+
+    ACTIVE = ("queued", "running")
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS srt_jobs ("
+                "id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+                "file_name TEXT NOT NULL, target_lang TEXT NOT NULL, target_flag TEXT NOT NULL, "
+                "status TEXT NOT NULL, total INTEGER NOT NULL, done INTEGER NOT NULL DEFAULT 0, "
+                "progress_message_id INTEGER, source TEXT NOT NULL, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL, targets TEXT)"
+            )
+            # Databases created before multi-target jobs lack the targets column
+            columns = {row["name"] for row in self._db.execute("PRAGMA table_info(srt_jobs)")}
+            if "targets" not in columns:
+                self._db.execute("ALTER TABLE srt_jobs ADD COLUMN targets TEXT")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_srt_jobs_user ON srt_jobs(user_id, created_at)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS srt_job_cues ("
+                "job_id TEXT NOT NULL, position INTEGER NOT NULL, text TEXT NOT NULL, "
+                "PRIMARY KEY (job_id, position))"
+            )
+            self._db.commit()
+        return self._db
+
+    def create(self, job):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT INTO srt_jobs (id, user_id, chat_id, file_name, target_lang, target_flag, status, total, "
+                "done, progress_message_id, source, created_at, updated_at, targets) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?)",
+                (job["id"], job["user_id"], job["chat_id"], job["file_name"], job["target_lang"],
+                 job["target_flag"], "queued", job["total"], job["progress_message_id"], job["source"], now, now,
+                 json.dumps(job["targets"]) if job.get("targets") else None)
+            )
+            db.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connect().execute("SELECT * FROM srt_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def active_ids(self):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id FROM srt_jobs WHERE status IN (?, ?) ORDER BY created_at", self.ACTIVE
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def for_user(self, user_id, limit=5):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id, file_name, target_lang, target_flag, status, total, done FROM srt_jobs "
+                "WHERE user_id = ? ORDER BY created_at DESC LIMIT ?", (user_id, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def set_status(self, job_id, status, error=None):
+        """Update a job's status; returns False if the job had already finished (done, failed or cancelled)"""
+        with self._lock:
+            db = self._connect()
+            updated = db.execute(
+                "UPDATE srt_jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status IN (?, ?)",
+                (status, error, time.time(), job_id, *self.ACTIVE)
+            ).rowcount
+            if updated and status not in self.ACTIVE:
+                # Finished jobs no longer need their source or checkpoints
+                db.execute("UPDATE srt_jobs SET source = '' WHERE id = ?", (job_id,))
+                db.execute("DELETE FROM srt_job_cues WHERE job_id = ?", (job_id,))
+            db.commit()
+        return bool(updated)
+
+    def checkpoint(self, job_id, items, done):
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT status FROM srt_jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row["status"] not in self.ACTIVE:
+                return  # e.g. a write that was already in a thread when the job was cancelled
+            db.executemany(
+                "INSERT OR REPLACE INTO srt_job_cues (job_id, position, text) VALUES (?, ?, ?)",
+                [(job_id, position, text) for position, text in items]
+            )
+            db.execute("UPDATE srt_jobs SET done = ?, updated_at = ? WHERE id = ?", (done, time.time(), job_id))
+            db.commit()
+
+    def completed_cues(self, job_id):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT position, text FROM srt_job_cues WHERE job_id = ?", (job_id,)
+            ).fetchall()
+        return {row["position"]: row["text"] for row in rows}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class SRTJobQueue:
+    """Worker pool that translates queued SRT jobs, checkpointing every batch"""
+
+    def __init__(self, store, workers=SRT_WORKERS):
+        self.store = store
+        self.workers = workers
+        self._queue = None
+        self._worker_tasks = []
+        self._running = {}  # job id -> task
+        self._cancelled = set()
+        self.bot = None
+
+    async def start(self, bot):
+        """Start the workers and re-queue jobs interrupted by a restart"""
+        self.bot = bot
+        self._queue = asyncio.Queue()
+        for job_id in await asyncio.to_thread(self.store.active_ids):
+            logger.info(f"♻️ Resuming SRT job {job_id}")
+            self._queue.put_nowait(job_id)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers; running jobs stay active and resume on the next start"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self.store.close()
+
+    async def submit(self, user_id, chat_id, file_name, targets, source, cue_count, progress_message_id):
+        """Queue a new job translating into every (language name, flag) in targets and return its id"""
+        job_id = uuid.uuid4().hex[:8]
+        await asyncio.to_thread(self.store.create, {
+            "id": job_id,
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "file_name": file_name,
+            "target_lang": ", ".join(name for name, _ in targets),
+            "target_flag": "".join(flag for _, flag in targets),
+            "targets": targets if len(targets) > 1 else None,
+            "total": cue_count * len(targets),
+            "progress_message_id": progress_message_id,
+            "source": source
+        })
+        await self._queue.put(job_id)
+        return job_id
+
+    def queued_count(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def jobs_for(self, user_id):
+        return await asyncio.to_thread(self.store.for_user, user_id)
+
+    async def cancel(self, job_id, user_id):
+        """Cancel a queued or running job owned by user_id; returns True if cancelled"""
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if not job or job["user_id"] != user_id or job["status"] not in SRTJobStore.ACTIVE:
+            return False
+        self._cancelled.add(job_id)
+        # Stop the worker first so it cannot checkpoint, finish or send the file afterwards
+        task = self._running.get(job_id)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if not await asyncio.to_thread(self.store.set_status, job_id, "cancelled"):
+            return False  # finished before the cancel took effect
+        await self._edit_progress(job, f"🛑 បានបោះបង់ការងារ #{job_id}")
+        return True
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                if job_id in self._cancelled:
+                    continue
+                task = asyncio.create_task(self._run(job_id))
+                self._running[job_id] = task
                 try:
-                    response = client.chat.completions.create(
-                        model="aisingapore/Gemma-SEA-LION-v4-27B-IT",
-                        messages=[{
-                            "role": "user", 
-                            "content": f"Translate this SRT subtitle text to {target_lang} language. Preserve any formatting markers and only output the translated text: {text_to_translate}"
-                        }],
-                        temperature=0.3,
-                        max_tokens=300
-                    )
-                    result = response.choices[0].message.content.strip()
-                    return result
-                except Exception as e:
-                    logger.warning(f"Sea Lion failed for SRT: {e}")
-        
-        # Use Groq as fallback or for non-SEA languages
-        client = get_groq_client()
-        if client:
-            response = client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": f"You are a professional SRT subtitle translator. Translate the following subtitle text to {target_lang} language. Preserve all formatting, line breaks, and special markers. Output ONLY the translated text without explanations."
-                    },
-                    {
-                        "role": "user", 
-                        "content": text_to_translate
-                    }
-                ],
-                temperature=0.2,
-                max_tokens=300
+                    await task
+                except asyncio.CancelledError:
+                    if job_id not in self._cancelled:
+                        raise  # worker shutdown, not a user cancel
+                    logger.info(f"🛑 SRT job {job_id} cancelled")
+            except asyncio.CancelledError:
+                self._running.pop(job_id, None)
+                raise
+            except Exception as e:
+                logger.error(f"SRT job {job_id} failed: {e}")
+                await self._fail(job_id, e)
+            finally:
+                self._running.pop(job_id, None)
+                self._cancelled.discard(job_id)
+                self._queue.task_done()
+
+    async def _fail(self, job_id, error):
+        """Mark a job failed and tell the user"""
+        try:
+            if not await asyncio.to_thread(self.store.set_status, job_id, "failed", str(error)):
+                return  # cancelled meanwhile
+            job = await asyncio.to_thread(self.store.get, job_id)
+            await self.bot.send_message(
+                job["chat_id"],
+                "❌ កំហុសក្នុងការដំណើរការឯកសារ SRT។\n"
+                "សូមព្យាយាមម្តងទៀត ឬពិនិត្យថាឯកសារត្រឹមត្រូវ។"
             )
-            result = response.choices[0].message.content.strip()
-            return result
-        
-        return text_to_translate  # Return original if no client available
-        
-    except Exception as e:
-        logger.error(f"SRT Translation error: {e}")
-        return text_to_translate  # Return original on error
+        except Exception as e:
+            logger.error(f"Failed to report SRT job {job_id} failure: {e}")
+
+    async def _edit_progress(self, job, text):
+        if not job["progress_message_id"]:
+            return
+        try:
+            with trace_span("progress"):
+                await self.bot.edit_message_text(text, chat_id=job["chat_id"], message_id=job["progress_message_id"])
+        except Exception as e:
+            logger.debug(f"Progress update skipped: {e}")
+
+    async def _run(self, job_id):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if not job or job["status"] not in SRTJobStore.ACTIVE:
+            return
+        with request_trace("srt_job", job["user_id"], TRACE_JOB_LOG_THRESHOLD):
+            reporter = ProgressReporter(lambda text: self._edit_progress(job, text))
+            try:
+                await self._translate_job(job_id, job, reporter)
+            finally:
+                await reporter.close()
+
+    async def _translate_job(self, job_id, job, reporter):
+        await asyncio.to_thread(self.store.set_status, job_id, "running")
+        targets = json.loads(job["targets"]) if job["targets"] else [(job["target_lang"], job["target_flag"])]
 
+        # Parse once; every target translates the same cues
+        with trace_span("parse"):
+            entries = parse_srt_content(job["source"])
+        cue_count = len(entries)
+        completed = await asyncio.to_thread(self.store.completed_cues, job_id)
+        done_count = len(completed)
+        grand_total = cue_count * len(targets)
+        progress = [0] * len(targets)
+        # Positions per target left in the source language after all retries
+        untranslated = [set() for _ in targets]
+        reporter.update(f"🔄 កំពុងបកប្រែ {cue_count} ជួរទៅជា {job['target_flag']} {job['target_lang']}... (#{job_id})")
+
+        # Checkpoints of target k are stored at positions k * cue_count + i
+        def translate_target(k, target_lang):
+            offset = k * cue_count
+
+            async def save_checkpoint(items):
+                nonlocal done_count
+                done_count += len(items)
+                await asyncio.to_thread(
+                    self.store.checkpoint, job_id, [(offset + i, text) for i, text in items], done_count
+                )
+
+            async def show_progress(previous, done, total):
+                # Progress across all targets; the reporter sends only the latest state per interval
+                progress[k] = done
+                after = sum(progress)
+                if after < grand_total:
+                    reporter.update(f"🔄 បកប្រែរួចហើយ {after}/{grand_total} ជួរ... (#{job_id})")
+
+            return translate_srt_entries(
+                entries, target_lang,
+                on_progress=show_progress,
+                completed={p - offset: text for p, text in completed.items() if offset <= p < offset + cue_count},
+                on_checkpoint=save_checkpoint,
+                user_id=job["user_id"],
+                untranslated=untranslated[k]
+            )
+
+        with trace_span("translate"):
+            results = await asyncio.gather(*(
+                translate_target(k, target_lang) for k, (target_lang, _) in enumerate(targets)
+            ))
+
+        # No progress edits may land after the result
+        await reporter.close()
+        if job_id in self._cancelled:
+            return
+
+        # Send translated files back straight from memory; several targets go in one zip archive
+        original_name = job["file_name"].rsplit('.', 1)[0]
+        failed_count = sum(len(positions) for positions in untranslated)
+        if failed_count:
+            logger.warning(f"SRT job {job_id}: {failed_count} cues left untranslated")
+        warning = f"\n⚠️ មិនបានបកប្រែ {failed_count} ជួរ (នៅជាភាសាដើម)" if failed_count else ""
+        with trace_span("upload"):
+            if len(targets) == 1:
+                target_lang, target_flag = targets[0]
+                await self.bot.send_document(
+                    job["chat_id"],
+                    document=serialize_srt(results[0]),
+                    filename=srt_output_name(original_name, target_lang),
+                    caption=f"✅ បកប្រែរួចរាល់ទៅជា {target_flag} {target_lang}\n\n"
+                           f"ចំនួនជួរ: {cue_count}\n"
+                           f"ប្រើ AI: {model_router.primary_name(target_lang)}" + warning
+                )
+            else:
+                archive = io.BytesIO()
+                with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as bundle:
+                    for (target_lang, _), translated_entries in zip(targets, results):
+                        bundle.writestr(srt_output_name(original_name, target_lang), serialize_srt(translated_entries))
+                await self.bot.send_document(
+                    job["chat_id"],
+                    document=archive.getvalue(),
+                    filename=f"{original_name}_multi.zip",
+                    caption="✅ បកប្រែរួចរាល់ទៅជា " + " ".join(f"{flag} {name}" for name, flag in targets) + "\n\n"
+                           f"ចំនួនជួរ: {cue_count} × {len(targets)} ភាសា" + warning
+                )
+
+        if job_id in self._cancelled or not await asyncio.to_thread(self.store.set_status, job_id, "done"):
+            return
+
+        # Delete processing message
+        if job["progress_message_id"]:
+            try:
+                await self.bot.delete_message(job["chat_id"], job["progress_message_id"])
+            except Exception as e:
+                logger.debug(f"Progress message not deleted: {e}")
+
+srt_jobs = SRTJobQueue(SRTJobStore(JOBS_DB_PATH))
+
+@traced("handle_srt_file")
 async def handle_srt_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle SRT file upload and translation"""
+    """Handle SRT file upload and queue it for translation"""
     user_id = update.effective_user.id
-    target_lang, target_flag = user_settings.get(user_id, ("Khmer", "🇰🇭"))
+    with trace_span("settings"):
+        targets = await get_user_targets(user_id)
+    target_names = " ".join(f"{flag} {name}" for name, flag in targets)
     
     # Check if message has document
     if not update.message.document:
@@ -252,83 +3138,42 @@ async def handle_srt_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Show processing message
-        processing_msg = await update.message.reply_text("🔄 កំពុងដំណើរការឯកសារ SRT...")
-        
-        # Download the file
-        file = await context.bot.get_file(document.file_id)
+        with trace_span("reply"):
+            processing_msg = await update.message.reply_text("🔄 កំពុងដំណើរការឯកសារ SRT...")
         
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(mode='w+', suffix='.srt', delete=False) as temp_file:
-            file_path = temp_file.name
-            await file.download_to_drive(file_path)
-            
-            # Read the SRT content
-            with open(file_path, 'r', encoding='utf-8') as f:
-                srt_content = f.read()
+        # Download straight into memory and normalise encoding / line endings
+        with trace_span("download"):
+            file = await context.bot.get_file(document.file_id)
+            data = bytes(await file.download_as_bytearray())
+        with trace_span("parse"):
+            srt_content = decode_srt_bytes(data)
+            # Count cues without keeping them; the worker parses again from the stored text
+            cue_count = sum(1 for _ in iter_srt_cues(srt_content))
         
-        # Parse SRT content
-        entries = parse_srt_content(srt_content)
-        
-        if not entries:
-            await update.message.reply_text("❌ មិនអាចអានឯកសារ SRT បាន។")
+        if not cue_count:
+            await processing_msg.edit_text("❌ មិនអាចអានឯកសារ SRT បាន។")
             return
         
-        # Check file size (limit to 50 entries for free tier)
-        if len(entries) > 50:
-            await update.message.reply_text(
-                f"⚠️ ឯកសារមាន {len(entries)} ជួរ។ កំណត់អតិបរមា 50 ជួរសម្រាប់ថ្នាក់ឥតគិតថ្លៃ។\n"
+        # Check file size against the configured limit
+        if SRT_MAX_ENTRIES and cue_count > SRT_MAX_ENTRIES:
+            await processing_msg.edit_text(
+                f"⚠️ ឯកសារមាន {cue_count} ជួរ។ កំណត់អតិបរមា {SRT_MAX_ENTRIES} ជួរ។\n"
                 f"សូមកាត់ឯកសារឱ្យតូចជាងនេះ។"
             )
             return
         
-        # Translate each entry
-        await processing_msg.edit_text(f"🔄 កំពុងបកប្រែ {len(entries)} ជួរទៅជា {target_lang}...")
-        
-        translated_entries = []
-        for i, entry in enumerate(entries):
-            # Show progress every 10 entries
-            if i % 10 == 0 and i > 0:
-                await processing_msg.edit_text(f"🔄 បកប្រែរួចហើយ {i}/{len(entries)} ជួរ...")
-            
-            translated_text = translate_srt_text(entry['text'], target_lang)
-            
-            # Create new entry with translated text
-            translated_entries.append({
-                'index': entry['index'],
-                'timestamp': entry['timestamp'],
-                'text': translated_text
-            })
-        
-        # Create translated SRT content
-        translated_srt = ""
-        for entry in translated_entries:
-            translated_srt += f"{entry['index']}\n{entry['timestamp']}\n{entry['text']}\n\n"
-        
-        # Create temporary file for translated SRT
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.srt', delete=False, encoding='utf-8') as temp_file:
-            temp_file.write(translated_srt)
-            translated_file_path = temp_file.name
-        
-        # Send translated file back
-        with open(translated_file_path, 'rb') as f:
-            # Create new file name with language code
-            original_name = document.file_name.rsplit('.', 1)[0]
-            new_name = f"{original_name}_{target_lang[:2].lower()}.srt"
-            
-            await update.message.reply_document(
-                document=f,
-                filename=new_name,
-                caption=f"✅ បកប្រែរួចរាល់ទៅជា {target_flag} {target_lang}\n\n"
-                       f"ចំនួនជួរ: {len(entries)}\n"
-                       f"ប្រើ AI: {'Sea Lion' if target_lang in ['Khmer', 'Thai', 'Vietnamese', 'Lao', 'Indonesian', 'Malay', 'Burmese', 'Filipino'] else 'Groq/Llama'}"
+        # Queue the job; a worker translates it in the background (traced as "srt_job")
+        with trace_span("enqueue"):
+            job_id = await srt_jobs.submit(
+                user_id, update.effective_chat.id, document.file_name, targets,
+                srt_content, cue_count, processing_msg.message_id
+            )
+        with trace_span("reply"):
+            await processing_msg.edit_text(
+                f"📥 បានដាក់ក្នុងជួរ ({cue_count} ជួរ → {target_names})\n"
+                f"🆔 ការងារ: #{job_id}\n"
+                f"ប្រើ /jobs ដើម្បីមើលដំណើរការ ឬ /cancel {job_id} ដើម្បីបោះបង់។"
             )
-        
-        # Clean up temporary files
-        os.unlink(file_path)
-        os.unlink(translated_file_path)
-        
-        # Delete processing message
-        await processing_msg.delete()
         
     except Exception as e:
         logger.error(f"SRT processing error: {e}")
@@ -337,6 +3182,40 @@ async def handle_srt_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "សូមព្យាយាមម្តងទៀត ឬពិនិត្យថាឯកសារត្រឹមត្រូវ។"
         )
 
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the user's recent SRT jobs"""
+    jobs = await srt_jobs.jobs_for(update.effective_user.id)
+    if not jobs:
+        await update.message.reply_text("📭 មិនមានការងារ SRT ទេ។")
+        return
+    
+    status_icons = {"queued": "⏳", "running": "🔄", "done": "✅", "failed": "❌", "cancelled": "🛑"}
+    lines = ["📋 **ការងារ SRT:**\n"]
+    for job in jobs:
+        percent = round(job["done"] * 100 / job["total"]) if job["total"] else 0
+        lines.append(
+            f"{status_icons.get(job['status'], '•')} `#{job['id']}` {escape_markdown(job['file_name'])} → "
+            f"{job['target_flag']} {job['done']}/{job['total']} ({percent}%)"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel an SRT job: /cancel <id>, or the latest active job"""
+    user_id = update.effective_user.id
+    if context.args:
+        job_id = context.args[0].lstrip("#")
+    else:
+        active = [job for job in await srt_jobs.jobs_for(user_id) if job["status"] in SRTJobStore.ACTIVE]
+        if not active:
+            await update.message.reply_text("📭 មិនមានការងារដែលកំពុងដំណើរការទេ។")
+            return
+        job_id = active[0]["id"]
+    
+    if await srt_jobs.cancel(job_id, user_id):
+        await update.message.reply_text(f"🛑 បានបោះបង់ការងារ #{job_id}")
+    else:
+        await update.message.reply_text(f"❌ រកមិនឃើញការងារសកម្ម #{job_id}")
+
 # --- Telegram Bot Handlers ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -350,7 +3229,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📁 **គាំទ្រឯកសារ SRT:**\n"
         "• ផ្ញើឯកសារ .srt មក ខ្ញុំនឹងបកប្រែស្រ្តីសម្រាប់អ្នក\n\n"
         f"⚙️ **បច្ចុប្បន្ន:** ភាសាគោលដៅគឺ **ខ្មែរ 🇰🇭**\n"
-        f"🔑 **API Status:** Groq({len(client_groq_list)}), Sea Lion({len(client_sealion_list)})"
+        f"🔑 **API Status:** Groq({groq_provider.key_count}), Sea Lion({sealion_provider.key_count})"
     )
     await update.message.reply_text(welcome_text, parse_mode='Markdown')
 
@@ -371,15 +3250,14 @@ async def list_languages(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def set_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set user's target language"""
     user_id = update.effective_user.id
-    command = update.message.text.replace("/", "").lower()
+    code = resolve_lang_code(update.message.text.split()[0])
     
-    if command in LANG_CODES:
-        lang_name, flag = LANG_CODES[command]
-        user_settings[user_id] = (lang_name, flag)
+    if code:  # always set: the handler only matches LANG_COMMANDS
+        lang_name, flag = LANG_CODES[code]
+        await settings_store.update(user_id, lang=code, multi=None)
         
         # Check which AI will be used
-        sea_langs = ["Khmer", "Thai", "Vietnamese", "Lao", "Indonesian", "Malay", "Burmese", "Filipino"]
-        ai_type = "Sea Lion" if lang_name in sea_langs else "Groq/Llama"
+        ai_type = model_router.primary_name(lang_name)
         
         await update.message.reply_text(
             f"✅ **បានកំណត់ភាសាគោលដៅ:** {flag} **{lang_name}**\n\n"
@@ -393,95 +3271,125 @@ async def set_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "❌ មិនស្គាល់ភាសា។ សូមប្រើ `/list` ដើម្បីមើលភាសាដែលមាន។"
         )
 
+async def multi_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set several target languages: /multi kh th en, or /multi off"""
+    user_id = update.effective_user.id
+    args = [arg.lower() for arg in context.args or []]
+    
+    if not args:
+        targets = await get_user_targets(user_id)
+        await update.message.reply_text(
+            "🌐 **ភាសាគោលដៅ:** " + " ".join(f"{flag} {name}" for name, flag in targets) + "\n\n"
+            "ប្រើ `/multi kh th en` ដើម្បីបកប្រែទៅច្រើនភាសាក្នុងពេលតែមួយ ឬ `/multi off` ដើម្បីបិទ។",
+            parse_mode='Markdown'
+        )
+        return
+    
+    if args == ["off"]:
+        await settings_store.update(user_id, multi=None)
+        lang_name, flag = await get_user_lang(user_id)
+        await update.message.reply_text(f"✅ បានបិទរបៀបច្រើនភាសា។ ភាសាគោលដៅ: {flag} {lang_name}")
+        return
+    
+    unknown = [arg for arg in args if not resolve_lang_code(arg)]
+    codes = list(dict.fromkeys(resolve_lang_code(arg) for arg in args if resolve_lang_code(arg)))
+    if unknown or len(codes) < 2 or len(codes) > MULTI_MAX_TARGETS:
+        await update.message.reply_text(
+            f"❌ សូមជ្រើសរើស 2 ដល់ {MULTI_MAX_TARGETS} ភាសា (ឧទាហរណ៍: `/multi kh th en`)។"
+            + (f"\nមិនស្គាល់: {escape_markdown(', '.join(unknown))}" if unknown else ""),
+            parse_mode='Markdown'
+        )
+        return
+    
+    await settings_store.update(user_id, multi=codes)
+    await update.message.reply_text(
+        "✅ **បានកំណត់ភាសាគោលដៅច្រើន:** " + " ".join(f"{LANG_CODES[code][1]} {LANG_CODES[code][0]}" for code in codes)
+        + "\n\nសារ និងឯកសារ SRT នឹងត្រូវបកប្រែទៅគ្រប់ភាសាទាំងនេះ។",
+        parse_mode='Markdown'
+    )
+
+async def reply_streaming(message, text_to_translate, target_lang, target_flag, user_id=None):
+    """Reply with the first streamed chunk, then keep the reply edited with the newest text"""
+    reporter = None
+    buffer = ""
+    try:
+        async for delta in stream_translation(text_to_translate, target_lang, user_id=user_id):
+            buffer += delta
+            if not buffer.strip():
+                continue
+            text = f"{target_flag} {buffer.strip()}"
+            if reporter is None:
+                sent = await message.reply_text(text)
+                reporter = ProgressReporter(sent.edit_text, interval=STREAM_EDIT_INTERVAL, shown=text)
+            else:
+                # Edits run in the background, so slow edits never hold up the stream
+                reporter.update(text)
+    finally:
+        if reporter is not None:
+            await reporter.close()
+
+    final = f"{target_flag} {buffer.strip()}"
+    if reporter is None:
+        await message.reply_text(final)
+    else:
+        await reporter.close(final=final)
+
+@traced("translate_ai")
 async def translate_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Translate user's message"""
     user_id = update.effective_user.id
-    target_lang, target_flag = user_settings.get(user_id, ("Khmer", "🇰🇭"))
+    with trace_span("settings"):
+        targets = await get_user_targets(user_id)
+    target_lang, target_flag = targets[0]
     text_to_translate = update.message.text
     
-    # Southeast Asian languages that Sea Lion handles well
-    sea_langs = ["Khmer", "Thai", "Vietnamese", "Lao", "Indonesian", "Malay", "Burmese", "Filipino"]
-    
     try:
         # Show typing indicator
-        await update.message.chat.send_action(action="typing")
+        with trace_span("typing"):
+            await update.message.chat.send_action(action="typing")
         
-        # Choose API based on language
-        if target_lang in sea_langs:
-            # Try Sea Lion first
-            client = get_sealion_client()
-            if client:
-                logger.info(f"Using Sea Lion for {target_lang}")
-                try:
-                    response = client.chat.completions.create(
-                        model="aisingapore/Gemma-SEA-LION-v4-27B-IT",
-                        messages=[{
-                            "role": "user", 
-                            "content": f"Translate this to {target_lang} language. Output only the translation: {text_to_translate}"
-                        }],
-                        temperature=0.3,
-                        max_tokens=200
-                    )
-                    result = response.choices[0].message.content.strip()
-                except Exception as e:
-                    logger.warning(f"Sea Lion failed: {e}, falling back to Groq")
-                    client = get_groq_client()
-                    if client:
-                        response = client.chat.completions.create(
-                            model="llama-3.3-70b-versatile",
-                            messages=[
-                                {"role": "system", "content": f"Translate to {target_lang}"},
-                                {"role": "user", "content": text_to_translate}
-                            ],
-                            temperature=0.2,
-                            max_tokens=200
-                        )
-                        result = response.choices[0].message.content.strip()
-                    else:
-                        result = "❌ មិនមាន API ដែលអាចប្រើបាន"
-            else:
-                # Fall back to Groq if no Sea Lion
-                client = get_groq_client()
-                if client:
-                    response = client.chat.completions.create(
-                        model="llama-3.3-70b-versatile",
-                        messages=[
-                            {"role": "system", "content": f"Translate to {target_lang}"},
-                            {"role": "user", "content": text_to_translate}
-                        ],
-                        temperature=0.2,
-                        max_tokens=200
-                    )
-                    result = response.choices[0].message.content.strip()
-                else:
-                    result = "❌ មិនមាន API ដែលអាចប្រើបាន"
-                    
-        else:
-            # Use Groq for non-SEA languages
-            client = get_groq_client()
-            if client:
-                logger.info(f"Using Groq for {target_lang}")
-                response = client.chat.completions.create(
-                    model="llama-3.3-70b-versatile",
-                    messages=[
-                        {
-                            "role": "system", 
-                            "content": f"You are a professional translator. Translate the user's text to {target_lang} language. Provide ONLY the translated text without any explanations, notes, or additional text."
-                        },
-                        {
-                            "role": "user", 
-                            "content": text_to_translate
-                        }
-                    ],
-                    temperature=0.2,
-                    max_tokens=200
-                )
-                result = response.choices[0].message.content.strip()
-            else:
-                result = "❌ មិនមាន Groq API ដែលអាចប្រើបាន"
+        if len(targets) > 1:
+            try:
+                with trace_span("translate"):
+                    results = await translate_multi(text_to_translate, [name for name, _ in targets], user_id=user_id)
+                reply = "\n\n".join(f"{flag} {result}" for (_, flag), result in zip(targets, results))
+            except NoClientAvailable:
+                reply = "❌ មិនមាន API ដែលអាចប្រើបាន"
+            with trace_span("reply"):
+                for part in split_text(reply, TELEGRAM_MESSAGE_LIMIT, measure=len):
+                    await update.message.reply_text(part)
+            return
+        
+        # Emoji, links, numbers or text already in the target language: nothing to translate
+        with trace_span("prefilter"):
+            skip = translation_skip_reason(text_to_translate, target_lang)
+        if skip:
+            with trace_span("reply"):
+                await update.message.reply_text(f"{target_flag} {text_to_translate}")
+            return
         
-        # Send the translation
-        await update.message.reply_text(f"{target_flag} {result}")
+        # Stream medium-length messages so the first words show up quickly;
+        # ones longer than a chunk are translated in parallel pieces instead
+        if (STREAM_TRANSLATIONS and len(text_to_translate) >= STREAM_MIN_CHARS
+                and estimate_tokens(text_to_translate) <= TEXT_CHUNK_TOKENS):
+            try:
+                with trace_span("stream"):
+                    await reply_streaming(update.message, text_to_translate, target_lang, target_flag, user_id)
+                return
+            except NoClientAvailable:
+                await update.message.reply_text("❌ មិនមាន API ដែលអាចប្រើបាន")
+                return
+        
+        try:
+            with trace_span("translate"):
+                result = await translate_long_text(text_to_translate, target_lang, user_id=user_id)
+        except NoClientAvailable:
+            result = "❌ មិនមាន API ដែលអាចប្រើបាន"
+        
+        # Send the translation, split if it outgrew one Telegram message
+        with trace_span("reply"):
+            for part in split_text(f"{target_flag} {result}", TELEGRAM_MESSAGE_LIMIT, measure=len):
+                await update.message.reply_text(part)
         
     except Exception as e:
         logger.error(f"Translation Error: {str(e)}")
@@ -501,6 +3409,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /list - មើលភាសាទាំងអស់
 /help - បង្ហាញសារនេះ
 /kh, /en, /th, /fr, ... - ជ្រើសរើសភាសាគោលដៅ
+/multi kh th en - បកប្រែទៅច្រើនភាសាក្នុងពេលតែមួយ
+/jobs - មើលការងារ SRT
+/cancel - បោះបង់ការងារ SRT
 
 **របៀបប្រើ:**
 1. ជ្រើសរើសភាសាដោយប្រើពាក្យបញ្ជា (ឧទាហរណ៍: `/en`)
@@ -519,17 +3430,23 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show bot status"""
+    cache_stats = translation_cache.stats()
     status_text = f"""
 🤖 **Bot Status**
 
 📊 **ទិន្នន័យ:**
-• អ្នកប្រើប្រាស់: {len(user_settings)}
+• អ្នកប្រើប្រាស់: {await settings_store.count()}
 • ភាសាដែលគាំទ្រ: {len(LANG_CODES)}
 • Uptime: {round(time.time() - start_time, 1)} វិនាទី
 
 🔑 **API Status:**
-• Groq Clients: {len(client_groq_list)}/{len(GROQ_KEYS)}
-• Sea Lion Clients: {len(client_sealion_list)}/{len(SEA_KEYS)}
+• Groq Clients: {groq_provider.clients_initialized()}/{len(GROQ_KEYS)}
+• Sea Lion Clients: {sealion_provider.clients_initialized()}/{len(SEA_KEYS)}
+
+💾 **Cache:**
+• Hits: {cache_stats['memory_hits']} (memory) / {cache_stats['disk_hits']} (disk)
+• Misses: {cache_stats['misses']}
+• Hit rate: {round(cache_stats['hit_rate'] * 100, 1)}%
 
 📁 **ឯកសារ SRT:** បានគាំទ្រ
 
@@ -537,41 +3454,112 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
     await update.message.reply_text(status_text, parse_mode='Markdown')
 
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin only: sample the bot's stacks for a few seconds and send back the collapsed-stack file"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("⛔ ពាក្យបញ្ជានេះសម្រាប់តែអ្នកគ្រប់គ្រងប៉ុណ្ណោះ។")
+        return
+    if profiler.running:
+        await update.message.reply_text("⏳ Profiler កំពុងដំណើរការរួចហើយ។")
+        return
+    try:
+        seconds = float(context.args[0]) if context.args else 10.0
+    except ValueError:
+        seconds = 10.0
+    seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+    
+    await update.message.reply_text(f"🔬 កំពុងវាស់ស្ទង់ {seconds:g} វិនាទី...")
+    path, data, samples = await profiler.run(seconds)
+    await update.message.reply_document(
+        document=data,
+        filename=os.path.basename(path),
+        caption=f"🔬 {samples} samples / {seconds:g}s\n"
+                f"flamegraph.pl {os.path.basename(path)} > flame.svg, ឬបើកក្នុង speedscope.app"
+    )
+
 # --- Main Function ---
 
-def main():
-    """Main function to start both Flask server and Telegram bot"""
-    
-    # Log initialization status
-    logger.info("=" * 60)
-    logger.info("🚀 Initializing Telegram AI Translator Bot")
-    logger.info(f"🔑 TELEGRAM_TOKEN: {'✅' if TOKEN else '❌'}")
-    logger.info(f"🤖 Groq API Keys: {len(GROQ_KEYS)} keys available, {len(client_groq_list)} clients initialized")
-    logger.info(f"🦁 Sea Lion API Keys: {len(SEA_KEYS)} keys available, {len(client_sealion_list)} clients initialized")
-    logger.info(f"🌐 Supported Languages: {len(LANG_CODES)}")
-    logger.info("📁 SRT File Support: ✅ Enabled")
-    logger.info("=" * 60)
-    
-    # Start Flask server in a background thread
-    flask_thread = threading.Thread(target=run_flask_server, daemon=True)
-    flask_thread.start()
-    logger.info("✅ Flask HTTP server started for health checks")
-    
-    # Give Flask a moment to start
-    time.sleep(2)
-    
-    # Create and configure Telegram bot application
-    application = Application.builder().token(TOKEN).build()
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handles updates from different chats concurrently while keeping each chat's updates in order
+
+    An update first waits for its chat's lock and only then takes one of `max_concurrent`
+    handler slots, so a chat with a backlog cannot hold slots other chats could use.
+    """
+
+    def __init__(self, max_concurrent, max_pending):
+        super().__init__(max(max_pending, max_concurrent))
+        self.max_concurrent = max_concurrent
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._chats = {}  # chat key -> [lock, updates holding or waiting for it]
+
+    @staticmethod
+    def chat_key(update):
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "effective_user", None)
+        return ("user", user.id) if user is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.chat_key(update)
+        entry = None
+        if key is not None:
+            entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+        started = False
+        UPDATES_WAITING.inc()
+        try:
+            async with entry[0] if entry else contextlib.nullcontext():
+                async with self._slots:
+                    UPDATES_WAITING.dec()
+                    UPDATES_ACTIVE.inc()
+                    started = True
+                    try:
+                        await coroutine
+                    finally:
+                        UPDATES_ACTIVE.dec()
+        finally:
+            if not started:
+                UPDATES_WAITING.dec()
+                coroutine.close()  # cancelled while queued; avoid a "never awaited" warning
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def build_application(request=None):
+    """Create the Telegram application and register all handlers
+
+    `request` replaces the HTTP layer for Bot API calls (used by bench/replay_updates.py).
+    """
+    builder = Application.builder().token(TOKEN)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    # Every outgoing call goes through flood control, so bursts queue instead of hitting RetryAfter
+    builder = builder.rate_limiter(TelegramRateLimiter())
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING))
+    application = builder.build()
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("list", list_languages))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("jobs", jobs_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CommandHandler("multi", multi_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     
-    # Add language selection handlers
-    for cmd in LANG_CODES.keys():
-        application.add_handler(CommandHandler(cmd, set_lang))
+    # Language choices: codes, aliases and English names. CommandHandler ignores unknown commands
+    # and ones addressed to another bot (/en@OtherBot)
+    application.add_handler(CommandHandler(list(LANG_COMMANDS), set_lang))
     
     # Add message handler for translation
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, translate_ai))
@@ -579,17 +3567,79 @@ def main():
     # Add document handler for SRT files (NEW)
     application.add_handler(MessageHandler(filters.Document.ALL, handle_srt_file))
     
-    # Start the bot
-    logger.info("🤖 Starting Telegram Translator Bot polling...")
+    return application
+
+async def run_bot():
+    """Serve HTTP routes and Telegram updates from one event loop"""
+    application = build_application()
+    server = uvicorn.Server(uvicorn.Config(
+        build_web_app(application),
+        host="0.0.0.0",
+        port=PORT,
+        log_level="warning"
+    ))
+    
+    # Start the web server first so health checks answer while the bot connects
+    logger.info(f"🌐 Starting HTTP server on port {PORT}")
+    server_task = asyncio.create_task(server.serve())
+    lag_task = asyncio.create_task(monitor_event_loop_lag())
     
-    # Run polling with proper error handling
     try:
-        application.run_polling(
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES,
-            close_loop=False,
-            poll_interval=1.0
-        )
+        async with application:
+            await application.start()
+            await srt_jobs.start(application.bot)
+            try:
+                if WEBHOOK_URL:
+                    logger.info(f"🤖 Starting Telegram Translator Bot webhook at {WEBHOOK_URL}{WEBHOOK_PATH}")
+                    await application.bot.set_webhook(
+                        url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                        allowed_updates=Update.ALL_TYPES,
+                        drop_pending_updates=True,
+                        secret_token=WEBHOOK_SECRET or None
+                    )
+                else:
+                    logger.info("🤖 Starting Telegram Translator Bot polling...")
+                    await application.updater.start_polling(
+                        drop_pending_updates=True,
+                        allowed_updates=Update.ALL_TYPES,
+                        poll_interval=POLL_INTERVAL
+                    )
+                
+                bot_ready.set()
+                logger.info(f"✅ Bot ready in {time.time() - start_time:.2f}s")
+                
+                # Runs until the server receives SIGINT/SIGTERM
+                await server_task
+            finally:
+                bot_ready.clear()
+                await srt_jobs.stop()
+                if application.updater.running:
+                    await application.updater.stop()
+                await application.stop()
+    finally:
+        lag_task.cancel()
+        if not server_task.done():
+            server.should_exit = True
+            await server_task
+        await close_resources(application)
+
+def main():
+    """Main function to start the HTTP server and Telegram bot"""
+    
+    # Log initialization status
+    logger.info("=" * 60)
+    logger.info("🚀 Initializing Telegram AI Translator Bot")
+    logger.info(f"🔑 TELEGRAM_TOKEN: {'✅' if TOKEN else '❌'}")
+    logger.info(f"🤖 Groq API Keys: {len(GROQ_KEYS)} keys available (clients start on first use)")
+    logger.info(f"🦁 Sea Lion API Keys: {len(SEA_KEYS)} keys available (clients start on first use)")
+    logger.info(f"🌐 Supported Languages: {len(LANG_CODES)}")
+    logger.info("📁 SRT File Support: ✅ Enabled")
+    logger.info(f"📡 Update Mode: {'webhook' if WEBHOOK_URL else 'polling'}")
+    logger.info("=" * 60)
+    
+    # Run HTTP server and bot with proper error handling
+    try:
+        asyncio.run(run_bot())
     except KeyboardInterrupt:
         logger.info("🛑 Bot stopped by user")
     except Exception as e: